@@ -154,14 +154,13 @@ class ActivateAction(Action):
     y = self.entity.y
     did_activate = False
     for d_x, d_y in ((0,1),(0,-1),(1,0),(-1,0),(1,1),(1,-1),(-1,-1),(-1,1)):
-      try:
-        tile = self.engine.game_map.tiles[x+d_x,y+d_y]
-        if tile['tile_class'] == 'door' and tile['tile_subclass'] == 'open' and not self.engine.game_map.get_actor_at_location(x+d_x,y+d_y):
-          self.engine.game_map.tiles[x+d_x,y+d_y] = self.engine.game_map.tile_set.get_tile_type('door','closed')
-          did_activate = True
-          break
-      except IndexError:
-        pass
+      if not self.engine.game_map.in_bounds(x+d_x, y+d_y):
+        continue
+      tile = self.engine.game_map.tiles[x+d_x,y+d_y]
+      if tile_types.is_door_open(tile) and not self.engine.game_map.get_actor_at_location(x+d_x,y+d_y):
+        self.engine.game_map.set_tile(x+d_x, y+d_y, self.engine.game_map.tile_set.get_tile_type('door','closed'))
+        did_activate = True
+        break
     if not did_activate:
       raise exceptions.Impossible("There's nothing to do here.")
 
@@ -176,9 +175,8 @@ class MovementAction(ActionWithDirection):
       raise exceptions.Impossible('That way is blocked.')
     #if self.engine.game_map.tiles[dest_x, dest_y] == tile_types.door_closed:
     #if self.engine.game_map.tile_set.is_tile_class(self.engine.game_map.tiles[dest_x, dest_y], 'door', 'closed'):
-    if self.engine.game_map.tiles[dest_x, dest_y]['tile_class'] == 'door' and \
-       self.engine.game_map.tiles[dest_x, dest_y]['tile_subclass'] == 'closed':
-      self.engine.game_map.tiles[dest_x, dest_y] = self.engine.game_map.tile_set.get_tile_type('door','open')#tile_types.door_open
+    if tile_types.is_door_closed(self.engine.game_map.tiles[dest_x, dest_y]):
+      self.engine.game_map.set_tile(dest_x, dest_y, self.engine.game_map.tile_set.get_tile_type('door','open'))#tile_types.door_open
       return
     if not self.engine.game_map.tiles["walkable"][dest_x, dest_y]:
       # Destination is blocked by a tile.
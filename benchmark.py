@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Headless benchmarks for the procgen pipeline.  No tcod context needed.
+
+Runs get_wfc for every brush set in brushes.json across a few grid sizes, and
+the full procgen_ship.generate_dungeon for each ship type across a fixed set of
+seeds, then dumps everything as JSON so runs can be diffed across commits:
+
+  python benchmark.py --output before.json
+  python benchmark.py --output after.json
+
+Every case is run twice with the same seed: once for wall time, and once under
+tracemalloc for peak memory, since tracing slows things down too much to time.
+Memory used in worker processes (--workers) isn't counted.
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+default_sizes = (10, 20, 30)
+default_seeds = (1, 2, 3, 4, 5)
+
+def measure(func):
+  """ Call func with its chatter swallowed.  Returns (result, seconds, peak bytes). """
+  with contextlib.redirect_stdout(io.StringIO()):
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return result, seconds, peak
+
+# (pattern count, width, height) -> seconds, see time_full_scan
+scan_times = {}
+
+def time_full_scan(pattern_count, width, height, repeats=20):
+  """ Median time of one call to the old full-grid cell selector on a fresh
+  width x height grid, to compare the entropy queue against.  Multiplied by a
+  run's collapses, it's roughly what cell selection used to cost. """
+  key = (pattern_count, width, height)
+  if key not in scan_times:
+    from wfc import location_with_fewest_choices
+
+    potential = np.full((height, width, pattern_count), True)
+    rng = random.Random(0)
+    times = []
+    for _ in range(repeats):
+      start = time.perf_counter()
+      location_with_fewest_choices(potential, rng)
+      times.append(time.perf_counter() - start)
+    scan_times[key] = float(np.median(times))
+  return scan_times[key]
+
+def get_selection_times(wfc_stats):
+  """ (seconds spent picking cells, estimated seconds the old full-grid scan
+  would have taken) for one get_wfc run's stats. """
+  scan_time = time_full_scan(wfc_stats['patterns'], wfc_stats['width'], wfc_stats['height'])
+  return wfc_stats['select_time'], scan_time * wfc_stats['collapses']
+
+def bench_wfc(brush_sets, sizes, seeds):
+  from brushes import get_compiled_rules
+  from wfc import get_wfc
+
+  results = []
+  for name, brush_set in brush_sets.items():
+    rules = get_compiled_rules(brush_set)
+    for size in sizes:
+      for seed in seeds:
+        stats = {}
+        def run():
+          stats.clear()
+          return get_wfc(rules=rules, width=size, height=size, stats=stats, seed=seed)
+        _, seconds, peak = measure(run)
+        results.append({'brush_set': name,
+                        'size': size,
+                        'seed': seed,
+                        'seconds': seconds,
+                        'peak_memory': peak,
+                        'tries': stats['tries'],
+                        'contradictions': stats['contradictions'],
+                        'backtracks': stats['backtracks'],
+                        'local_restarts': stats['local_restarts'],
+                        'restarts': stats['restarts'],
+                        'gave_up': stats['gave_up'],
+                        'select_time': stats['select_time'],
+                        'scan_time_estimate': get_selection_times(stats)[1]})
+        print(f'wfc {name} {size}x{size} seed {seed}: {seconds:.3f}s', file=sys.stderr)
+  return results
+
+def bench_ships(seeds, workers):
+  import entity_factories
+  import tile_types
+  from engine import Engine
+  from procgen_ship import create_generation_pool, generate_dungeon
+  from ships import HallShip, SphereStarShip
+
+  engine = Engine(player=copy.deepcopy(entity_factories.player))
+  # One pool for every run, the same way GameWorld keeps one for the whole game
+  pool = create_generation_pool(workers) if workers else None
+  results = []
+  for ship_class in (HallShip, SphereStarShip):
+    for seed in seeds:
+      def run():
+        ship = ship_class(tile_types.basic_tile_set.copy(), random.Random(seed))
+        return generate_dungeon(engine, ship, pool=pool, floor_number=1, place_player=False)
+      dungeon, seconds, peak = measure(run)
+      sectors = dungeon.generation_stats.get('sectors', [])
+      # What the entropy queue saved over the old full-grid scan, sector by sector
+      selection = [get_selection_times(s) for s in sectors]
+      results.append({'ship': ship_class.__name__,
+                      'seed': seed,
+                      'width': dungeon.width,
+                      'height': dungeon.height,
+                      'rooms': len(dungeon.rooms),
+                      'seconds': seconds,
+                      'peak_memory': peak,
+                      'stages': dungeon.generation_stats.get('stages', {}),
+                      'tries': sum(s['tries'] for s in sectors),
+                      'contradictions': sum(s['contradictions'] for s in sectors),
+                      'restarts': sum(s['restarts'] for s in sectors),
+                      'gave_up': sum(1 for s in sectors if s['gave_up']),
+                      'sector_selection': [{'select_time': select_time,
+                                            'scan_time_estimate': scan_time,
+                                            'saved': scan_time - select_time}
+                                           for select_time, scan_time in selection],
+                      'selection_saved': sum(scan_time - select_time for select_time, scan_time in selection)})
+      print(f'{ship_class.__name__} seed {seed}: {seconds:.3f}s, '
+            f'~{results[-1]["selection_saved"]:.4f}s saved on cell selection', file=sys.stderr)
+  if pool is not None:
+    pool.shutdown()
+  return results
+
+def summarize(results, key_fields):
+  """ Mean time/memory for each group of results sharing key_fields. """
+  groups = {}
+  for result in results:
+    groups.setdefault(tuple(result[k] for k in key_fields), []).append(result)
+  summary = []
+  for key, group in groups.items():
+    entry = dict(zip(key_fields, key))
+    entry['runs'] = len(group)
+    entry['mean_seconds'] = float(np.mean([r['seconds'] for r in group]))
+    entry['max_peak_memory'] = max(r['peak_memory'] for r in group)
+    stage_names = {name for r in group for name in r.get('stages', {})}
+    if stage_names:
+      entry['mean_stages'] = {name: float(np.mean([r['stages'].get(name, 0) for r in group]))
+                              for name in sorted(stage_names)}
+    summary.append(entry)
+  return summary
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark ship generation.')
+  parser.add_argument('--output', help='Write the JSON here instead of stdout')
+  parser.add_argument('--brushes', default='brushes.json')
+  parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='WFC grid sizes')
+  parser.add_argument('--seeds', type=int, nargs='+', default=default_seeds)
+  parser.add_argument('--workers', type=int, default=0, help='Processes for sector WFC in full ship runs')
+  parser.add_argument('--skip-wfc', action='store_true')
+  parser.add_argument('--skip-ships', action='store_true')
+  args = parser.parse_args()
+
+  from brushes import load_brushes
+
+  report = {'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'sizes': args.sizes,
+            'seeds': args.seeds,
+            'workers': args.workers}
+  if not args.skip_wfc:
+    report['wfc'] = bench_wfc(load_brushes(args.brushes), args.sizes, args.seeds)
+    report['wfc_summary'] = summarize(report['wfc'], ('brush_set', 'size'))
+  if not args.skip_ships:
+    report['ships'] = bench_ships(args.seeds, args.workers)
+    report['ships_summary'] = summarize(report['ships'], ('ship',))
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+
+if __name__ == '__main__':
+  main()
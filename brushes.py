@@ -1,5 +1,21 @@
-import numpy as np
+import hashlib
 import json
+import os
+import re
+import tempfile
+import zipfile
+import numpy as np
+
+from wfc import CompiledRules, compile_rules
+
+# Compiled WFC rules get saved to disk here as .npz files, keyed by the content
+# hash of the brushes file they came from, so unchanged brush sets never recompile.
+rules_cache_dir = '.ruleset_cache'
+# Part of every cache file's name.  Bump it whenever compile_rules or the
+# CompiledRules layout changes, so rules cached by older code aren't loaded.
+RULES_FORMAT_VERSION = 1
+# In-process memo of the same, keyed by (content hash, brush set name)
+compiled_rules = {}
 
 class Brush:
   def __init__(self, name, size=3, data = []):
@@ -34,16 +50,19 @@ class Brush:
   #  return np.all(self.data == other.data)
 
 class BrushSet:
-  def __init__(self, name, brush_size=3):
+  def __init__(self, name, brush_size=3, source_hash=None):
     self.name = name
     self.brush_size = int(brush_size)
     self.brushes = {}
+    self.source_hash = source_hash # Content hash of the brushes file we were loaded from
 
   def add_brush(self, brush, weight=1):
     if brush.size != self.brush_size:
       raise ValueError('Invalid brush size.  Expected size %s, got size %s' % (self.brush_size, brush.size))
     self.brushes[brush.name] = {'brush': brush,
                                 'weight': int(weight)}
+    # Edited in memory, so we no longer match what's on disk
+    self.source_hash = None
 
   def list_brushes(self):
     return self.brushes.values()
@@ -60,11 +79,23 @@ class BrushSet:
             'brushes': brushes}
 
 
+  def get_hash(self):
+    """The hash compiled rules for this brush set are cached under."""
+    if self.source_hash:
+      return self.source_hash
+    # Not straight from a brushes file, so hash our own contents
+    data = self.to_dict()
+    data['data'] = [b['brush'].data.tolist() for b in self.brushes.values()]
+    return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+
 def load_brushes(filename='brushes.json'):
   brushes = {}
   brush_sets = {}
-  with open('brushes.json', 'r') as f:
-    brush_data = json.loads(f.read())
+  with open(filename, 'r') as f:
+    contents = f.read()
+    source_hash = hashlib.sha1(contents.encode()).hexdigest()
+    brush_data = json.loads(contents)
     for b in brush_data['brushes']:
       brush = Brush(b['name'],b['size'],b['data'])
       brushes[brush.name] = brush
@@ -75,5 +106,58 @@ def load_brushes(filename='brushes.json'):
         if brush:
           weight = b['weight']
           brush_set.add_brush(brush, weight)
+      brush_set.source_hash = source_hash
       brush_sets[brush_set.name] = brush_set
   return brush_sets
+
+def get_compiled_rules(brush_set):
+  """
+  Return the CompiledRules for a brush set: every rotation of every brush,
+  deduplicated, with its side signatures, adjacency matrices and weights.
+  Only compiles if neither the in-process memo nor the disk cache has it.
+  """
+  source_hash = brush_set.get_hash()
+  key = (source_hash, brush_set.name)
+  rules = compiled_rules.get(key)
+  if rules:
+    return rules
+
+  cache_file = os.path.join(rules_cache_dir, f'{brush_set.name}-v{RULES_FORMAT_VERSION}-{source_hash}.npz')
+  try:
+    with np.load(cache_file) as data:
+      rules = CompiledRules(data['patterns'], data['sides'], data['weights'], data['adjacency'])
+  except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+    # Missing, or left broken by a crash mid-write.  Either way, just compile it again.
+    patterns = []
+    weights = []
+    for b in brush_set.list_brushes():
+      for data in b['brush'].get_all_rotations():
+        patterns.append(data)
+        weights.append(b['weight'])
+    rules = compile_rules(patterns, weights)
+    try:
+      os.makedirs(rules_cache_dir, exist_ok=True)
+      # Clear out rules compiled from older versions of this brush set (or by older
+      # code), without touching other sets whose names start the same way
+      old_cache = re.compile(re.escape(brush_set.name) + r'-(v\d+-)?[0-9a-f]+\.npz')
+      for filename in os.listdir(rules_cache_dir):
+        if old_cache.fullmatch(filename) and filename != os.path.basename(cache_file):
+          try:
+            os.remove(os.path.join(rules_cache_dir, filename))
+          except FileNotFoundError:
+            pass # Another thread (floor pregeneration) got to it first
+      # Write somewhere private and move it into place, so nothing ever loads half a file
+      fd, temp_file = tempfile.mkstemp(prefix=f'.{brush_set.name}-', suffix='.tmp', dir=rules_cache_dir)
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          np.savez(f, patterns=rules.patterns, sides=rules.sides,
+                   weights=rules.weights, adjacency=rules.adjacency)
+        os.replace(temp_file, cache_file)
+      except:
+        os.remove(temp_file)
+        raise
+    except OSError as e:
+      print(f'Unable to cache rules for brush set {brush_set.name}: {e}')
+
+  compiled_rules[key] = rules
+  return rules
@@ -0,0 +1,139 @@
+import numpy as np
+
+chunk_size = 32
+
+class ChunkedGrid:
+  """
+  A map sized 2D array stored as chunk_size x chunk_size blocks.  A chunk is only
+  made the first time something writes to it, and every cell outside the chunks
+  reads as fill_value, so a huge map only pays for the parts that get used.
+
+  Indexes like the dense array it replaces, as far as the map needs:  a single
+  cell (grid[x, y] or grid[(x, y)]) reads and writes a value, and a rectangle
+  (grid[x1:x2, y1:y2], or grid[:] for everything) reads as a dense copy and
+  writes from an array or a single value.
+  """
+  def __init__(self, shape, fill_value, dtype, size=chunk_size):
+    self.shape = tuple(shape)
+    self.fill_value = fill_value
+    self.dtype = np.dtype(dtype)
+    self.size = size
+    self.chunks = {}
+
+  def __len__(self):
+    return self.shape[0]
+
+  def fill(self, value):
+    """ Set every cell to value, dropping all the chunks. """
+    self.fill_value = value
+    self.chunks = {}
+
+  def clear(self):
+    """ Set every cell back to fill_value. """
+    self.chunks = {}
+
+  def copy(self):
+    grid = ChunkedGrid(self.shape, self.fill_value, self.dtype, self.size)
+    grid.chunks = {key: chunk.copy() for key, chunk in self.chunks.items()}
+    return grid
+
+  def _get_chunk(self, c_x, c_y):
+    chunk = self.chunks.get((c_x, c_y))
+    if chunk is None:
+      chunk = self.chunks[c_x, c_y] = np.full((self.size, self.size), self.fill_value, dtype=self.dtype, order='F')
+    return chunk
+
+  def _get_bounds(self, key):
+    """ (x1, x2, y1, y2) of a rectangular index, or None if it's a single cell.  An
+    int on one side picks out a single row or column. """
+    if key.__class__ is not tuple:
+      key = (key, slice(None))
+    s_x, s_y = key
+    if s_x.__class__ is not slice and s_y.__class__ is not slice:
+      return None
+    if s_x.__class__ is not slice:
+      s_x = self._get_cell((s_x, 0))[0]
+      s_x = slice(s_x, s_x + 1)
+    if s_y.__class__ is not slice:
+      s_y = self._get_cell((0, s_y))[1]
+      s_y = slice(s_y, s_y + 1)
+    x1, x2, x_step = s_x.indices(self.shape[0])
+    y1, y2, y_step = s_y.indices(self.shape[1])
+    if x_step != 1 or y_step != 1:
+      raise IndexError('ChunkedGrid only supports contiguous slices')
+    return x1, max(x2, x1), y1, max(y2, y1)
+
+  def _get_cell(self, key):
+    x, y = int(key[0]), int(key[1])
+    width, height = self.shape
+    if x < 0:
+      x += width
+    if y < 0:
+      y += height
+    if not (0 <= x < width and 0 <= y < height):
+      raise IndexError(f'({key[0]}, {key[1]}) is outside a {width}x{height} grid')
+    return x, y
+
+  def _overlaps(self, x1, x2, y1, y2):
+    """ Every chunk the rectangle touches, as (c_x, c_y, chunk slices, rectangle slices). """
+    size = self.size
+    for c_x in range(x1 // size, (x2 - 1) // size + 1):
+      o_x = c_x * size
+      a_x, b_x = max(x1, o_x), min(x2, o_x + size)
+      for c_y in range(y1 // size, (y2 - 1) // size + 1):
+        o_y = c_y * size
+        a_y, b_y = max(y1, o_y), min(y2, o_y + size)
+        yield (c_x, c_y,
+               (slice(a_x - o_x, b_x - o_x), slice(a_y - o_y, b_y - o_y)),
+               (slice(a_x - x1, b_x - x1), slice(a_y - y1, b_y - y1)))
+
+  def __getitem__(self, key):
+    if key.__class__ is not tuple:
+      key = (key, slice(None))
+    bounds = self._get_bounds(key)
+    if bounds is None:
+      x, y = self._get_cell(key)
+      chunk = self.chunks.get((x // self.size, y // self.size))
+      if chunk is None:
+        return self.dtype.type(self.fill_value)
+      return chunk[x % self.size, y % self.size]
+
+    x1, x2, y1, y2 = bounds
+    result = np.full((x2 - x1, y2 - y1), self.fill_value, dtype=self.dtype, order='F')
+    if x2 > x1 and y2 > y1:
+      for c_x, c_y, in_chunk, in_result in self._overlaps(x1, x2, y1, y2):
+        chunk = self.chunks.get((c_x, c_y))
+        if chunk is not None:
+          result[in_result] = chunk[in_chunk]
+    if key[0].__class__ is not slice:
+      return result[0]
+    if key[1].__class__ is not slice:
+      return result[:, 0]
+    return result
+
+  def __setitem__(self, key, value):
+    bounds = self._get_bounds(key)
+    if bounds is None:
+      x, y = self._get_cell(key)
+      self._get_chunk(x // self.size, y // self.size)[x % self.size, y % self.size] = value
+      return
+
+    x1, x2, y1, y2 = bounds
+    if x2 <= x1 or y2 <= y1:
+      return
+    is_scalar = np.ndim(value) == 0
+    if is_scalar and value == self.fill_value:
+      # Nothing to make, just reset the chunks that are already there
+      for c_x, c_y, in_chunk, _ in self._overlaps(x1, x2, y1, y2):
+        chunk = self.chunks.get((c_x, c_y))
+        if chunk is not None:
+          chunk[in_chunk] = value
+      return
+    if not is_scalar:
+      value = np.broadcast_to(value, (x2 - x1, y2 - y1))
+    for c_x, c_y, in_chunk, in_value in self._overlaps(x1, x2, y1, y2):
+      chunk_value = value if is_scalar else value[in_value]
+      if (c_x, c_y) not in self.chunks and not is_scalar and (chunk_value == self.fill_value).all():
+        # Don't make a chunk just to hold what it would read as anyway
+        continue
+      self._get_chunk(c_x, c_y)[in_chunk] = chunk_value
@@ -3,6 +3,7 @@ import random
 import numpy as np
 import tcod
 
+import tile_types
 from actions import Action, BumpAction, MeleeAction, TargetedRangedAttack, MovementAction, WaitAction, ActivateAction
 
 class BaseAI(Action):
@@ -15,10 +16,8 @@ class BaseAI(Action):
 
     # Copy the walkable array
     cost = np.array(self.entity.gamemap.tiles['walkable'], dtype=np.int8)
-    doors = np.where(self.entity.gamemap.tiles['tile_subclass'] == 'closed', 2, 0)
-    for x in range(0, len(doors)-1):
-      for y in range(0, len(doors[0]) -1):
-        cost[x][y] = cost[x][y] + doors[x][y]
+    # Closed doors cost a bit more to go through
+    cost[tile_types.is_door_closed(self.entity.gamemap.tiles)] += 2
 
     for entity in self.entity.gamemap.entities:
       # Check that an entity blocks movement and the cost isn't zero (blocking)
@@ -207,7 +206,7 @@ class Breather(BaseAI):
         #print('Who left the door open??')
         for e_x, e_y in my_room.exits:
           exit = self.engine.game_map.tiles[e_x, e_y]
-          if exit['tile_class'] == 'door' and exit['tile_subclass'] == 'open':
+          if tile_types.is_door_open(exit):
             if self.is_next_to(e_x, e_y):
               #print('I will close it!')
               return ActivateAction(self.entity).perform()
@@ -270,10 +269,10 @@ class Drifting(BaseAI):
             # We'd like to just reverse our original direction since that's safe. But
             # You can get caught in a loop this way, so first check to see if we can slide onto a floor
             if gamemap.in_bounds(self.entity.x + dx, self.entity.y) and \
-               gamemap.tiles[self.entity.x + dx, self.entity.y]['tile_class'] == 'floor':
+               tile_types.is_floor(gamemap.tiles[self.entity.x + dx, self.entity.y]):
               dy = 0
             elif gamemap.in_bounds(self.entity.x, self.entity.y + dy) and \
-               gamemap.tiles[self.entity.x, self.entity.y + dy]['tile_class'] == 'floor':
+               tile_types.is_floor(gamemap.tiles[self.entity.x, self.entity.y + dy]):
               dx = 0
             else:
               # No floor, just reverse.  If we're still caught in a death loop then may we just
@@ -293,7 +292,7 @@ class Drifting(BaseAI):
       self.entity.fighter.die()
 
     else:
-      if gamemap.tiles[self.entity.x + dx, self.entity.y + dy]['tile_class'] == 'floor':
+      if tile_types.is_floor(gamemap.tiles[self.entity.x + dx, self.entity.y + dy]):
         # We're are drifting on to a floor, resume normal operations after this action
         self.entity.ai = self.parent_ai
       if self.entity == self.engine.player:
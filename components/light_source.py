@@ -1,7 +1,25 @@
+import numpy as np
+
 from components.base_component import BaseComponent
 import exceptions
 import color
 
+# Falloff for each light radius we've seen, see get_light_kernel
+light_kernels = {}
+
+def get_light_kernel(radius):
+  """ How dark every tile within reach of a light is:  0 right at the light,
+  up to just under 1 at radius, and 1 (not lit at all) past it.  A square array
+  2 * radius + 1 wide, with the light in the middle.  Shared, so don't modify it. """
+  kernel = light_kernels.get(radius)
+  if kernel is None:
+    xs, ys = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    distance = np.sqrt(xs ** 2 + ys ** 2)
+    kernel = np.where(distance <= radius, distance / (radius + 2), 1.0)
+    kernel.flags.writeable = False
+    light_kernels[radius] = kernel
+  return kernel
+
 
 class LightSource(BaseComponent):
   def __init__(self, radius=5,tint=(0,0,0)):
@@ -4,13 +4,14 @@ import time
 
 from collections import deque
 
-import tcod
+import numpy as np
+
 from tcod.context import Context
 from tcod.console import Console
-from tcod.map import compute_fov
 
 from entity import Entity
 import exceptions
+from lighting import compute_light
 from message_log import MessageLog
 import render_functions
 import color
@@ -50,54 +51,33 @@ class Engine:
 
   def update_fov(self):
     """ Recompute visible area for player POV """
-    self.game_map.visible[:] = compute_fov(
-      self.game_map.tiles['transparent'],
-      (self.player.x, self.player.y),
-      radius=self.player.visibility,
-      algorithm=tcod.FOV_BASIC
-    )
-    #self.game_map.dim[:] = compute_fov(
-    #  self.game_map.tiles['transparent'],
-    #  (self.player.x, self.player.y),
-    #  radius=8,
-    #  algorithm=tcod.FOV_BASIC
-    #)
-
-    # If a tile is visible, it should be added to explored
-    #self.game_map.explored |= self.game_map.visible
-    #self.game_map.explored |= self.game_map.dim
+    # Only the square within the player's visibility gets worked out, everything else stays unseen
+    s_x, s_y, fov = self.game_map.compute_fov(self.player.x, self.player.y, self.player.visibility)
+    self.game_map.visible.clear()
+    self.game_map.visible[s_x, s_y] = fov
 
   def update_light_levels(self):
-    """ Create our light map for all static light entities """
-    self.game_map.light_levels[:] = 1
-    for light in [self.player]:#self.game_map.lights:
-      if light == self.player:
-        light_walls = True
-      else:
-        light_walls = self.game_map.visible[light.x][light.y]
-      coords = self.game_map.get_coords_in_radius(light.x, light.y, light.light_source.radius)
-      light_fov = compute_fov(
-        self.game_map.tiles['transparent'],
-        (light.x, light.y),
-        radius=light.light_source.radius,
-        algorithm=tcod.FOV_BASIC,
-        light_walls=light_walls
-      )
-      for x, y in coords:
-        if light_fov[x][y]:
-          distance = light.distance(x, y)
-          brightness_diff = distance / (light.light_source.radius+2)
-          if brightness_diff < self.game_map.light_levels[x][y]:
-            self.game_map.light_levels[x][y] = brightness_diff
-
-    explored = (self.game_map.light_levels < 1) & self.game_map.visible
-    self.game_map.explored |= explored
+    """ Create our light map from every light on the map """
+    game_map = self.game_map
+    # Lights the player can't see don't light up walls
+    static_lights = [(light, bool(game_map.visible[light.x, light.y]))
+                     for light in game_map.lights if light is not self.player]
+    game_map.light_levels = game_map.lighting.get_static_light_levels(static_lights).copy()
+
+    # The player's light moves with them, so it's always worked out fresh
+    s_x, s_y, light_levels = compute_light(game_map, self.player.x, self.player.y, self.player.light_source.radius)
+    game_map.light_levels[s_x, s_y] = np.minimum(game_map.light_levels[s_x, s_y], light_levels)
+
+    # Anything lit that the player can see has been explored
+    s_x, s_y = game_map.get_area_in_radius(self.player.x, self.player.y, self.player.visibility)
+    explored = (game_map.light_levels[s_x, s_y] < 1) & game_map.visible[s_x, s_y]
+    game_map.explored[s_x, s_y] = game_map.explored[s_x, s_y] | explored
 
   def update_vacuum(self):
     """ Mark tiles affected by vacuum sources """
-    vacuumed     = set()
-    for source in self.game_map.vacuum_sources:
-      vacuumed.update(self._vacuum(source, vacuumed))
+    # Air gets out of every room joined to a vacuum source by open doors.  Might need a
+    # "permeable" attribute at some point if we want tiles to allow air out without being walkable
+    vacuumed = self.game_map.room_graph.get_reachable(self.game_map.vacuum_sources, self.game_map.tiles['walkable'])
 
     vacuum_tiles = set()
     for room in vacuumed:
@@ -115,40 +95,12 @@ class Engine:
   def orbit(self):
     did_orbit = False
     if time.time() - self.last_update >= 1:
-      space_tiles = self.game_map.space_tiles
-      wrap = space_tiles[0:1, 0:len(space_tiles[0])]
-      space_tiles[0:len(space_tiles)-1, 0:len(space_tiles[0])] = space_tiles[1:len(space_tiles), 0:len(space_tiles[1])]
-      space_tiles[len(space_tiles)-1:len(space_tiles), 0:len(space_tiles[0])] = wrap
-
-      tiles = self.game_map.tiles
-      for x in range(len(tiles)-1, 0, -1):
-        for y in range(0, len(tiles[0])-1):
-          if tiles[x][y]['tile_class'] == 'space':
-            tiles[x][y] = space_tiles[x][y]
+      # Space tiles get drawn from the starfield at render time, so this is all it takes
+      self.game_map.scroll_starfield()
       did_orbit = True
       self.last_update = time.time()
     return did_orbit
 
-  def _vacuum(self, room, vacuumed):
-    """shlorp shlorp!"""
-    vacuumed.add(room)
-    #print(f'Vacuuming room with {len(room.connecting_rooms)} neighbors')
-    for neighbor in room.connecting_rooms:
-      if neighbor not in vacuumed:
-        connecting_exits = neighbor.exits.intersection(room.exits)
-        #print(f'Checking my exits {room.exits} against neighbor exits {neighbor.exits} and found {connecting_exits}')
-        for exit in connecting_exits:
-          if self.game_map.tiles[exit[0],exit[1]]['walkable']:
-            #print(f'Found neighbor to vacuum at exit ({exit[0]},{exit[1]}).  Spreading!')
-            # Might need a "permeable" attribute at some point if we want
-            # tiles to allow air out without being walkable
-            vacuumed.update(self._vacuum(neighbor, vacuumed))
-            break
-          else:
-            #print(f'Neighbor exit at ({exit[0]},{exit[1]}) is sealed.  You are safe for now!')
-            pass
-    return vacuumed
-
   def render(self, console):
     self.game_map.render(console)
 
@@ -1,6 +1,7 @@
 import copy
 import math
 from render_order import RenderOrder
+import tile_types
 from components.ai import ChainedAI, Drifting
 
 class Entity:
@@ -127,7 +128,7 @@ class Actor(Entity):
 
   def move(self, dx, dy):
     super().move(dx, dy)
-    if self.gamemap.tiles[self.x, self.y]['tile_class'] == 'space' and \
+    if tile_types.is_space(self.gamemap.tiles[self.x, self.y]) and \
        not isinstance(self.ai, Drifting):
       self.ai = Drifting(self, (dx, dy), self.ai)
 
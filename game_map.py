@@ -1,13 +1,23 @@
 import numpy as np
 import random
 import math
+import threading
+import weakref
+from collections import OrderedDict
 import tcod
 from tcod.console import Console
 from tcod.map import compute_fov
 
 from entity import Actor, Item, Container
+from rooms import RoomGraph
+from chunks import ChunkedGrid
+from lighting import Lighting
+import tile_bit_codes
 import tile_types
 
+starfield_size = 128
+fov_cache_size = 8
+
 class GameMap:
   def __init__(self, engine, ship, entities=()):
     self.engine = engine
@@ -15,25 +25,46 @@ class GameMap:
     self.width, self.height = width, height = ship.width, ship.height
     self.entities = set(entities)
     self.tile_set = ship.tile_set
-    self.tiles = np.full((width, height), fill_value=self.tile_set.get_tile_type('wall','basic'), order='F')
+    self.tiles = tile_types.TileGrid(self.tile_set, (width, height), self.tile_set.get_tile_type('wall','basic'))
     #self.vacuum = np.full((width, height), fill_value=False, order="F")  # Tiles that are in vacuum
-    self.visible = np.full((width, height), fill_value=False, order="F")  # Tiles currently in the players los
-    self.light_levels = np.full((width, height), fill_value=1.0, order="F")
-    self.explored = np.full((width, height), fill_value=False, order="F")  # Tiles the player has seen before
-
-    # Initialize our space field with random stars/empty space
-    self.space_tiles = np.full((width, height), fill_value=self.tile_set.get_tile_type('space', 'basic'))
-    for x in range(len(self.space_tiles)):
-      for y in range(len(self.space_tiles[0])):
-        self.space_tiles[x][y] = self.tile_set.get_tile_type('space')
+    # Per turn layers are chunked so only the parts of the map near the player take up space
+    self.visible = ChunkedGrid((width, height), fill_value=False, dtype=bool)  # Tiles currently in the players los
+    self.light_levels = ChunkedGrid((width, height), fill_value=1.0, dtype=float)
+    self.explored = ChunkedGrid((width, height), fill_value=False, dtype=bool)  # Tiles the player has seen before
+    self.lighting = Lighting(self)
+    # Bumped whenever a tile changes whether it can be seen through, see compute_fov
+    self.transparency_version = 0
+    self.fov_cache = OrderedDict()
+    # Which neighbours of each tile are walls or doors, see tile_bit_codes.  A map of solid wall is all 255.
+    self.bit_codes = np.full((width, height), fill_value=255, dtype=np.uint8, order="F")
+
+    # Initialize our space field with random stars/empty space.  It repeats past
+    # starfield_size, so big maps don't need one the size of the whole map.
+    starfield_shape = (min(width, starfield_size), min(height, starfield_size))
+    self.space_tiles = tile_types.TileGrid(self.tile_set, starfield_shape, self.tile_set.get_tile_type('space', 'basic'))
+    self.space_tiles[:] = self.tile_set.get_tile_types('space', count=starfield_shape)
+    # The starfield never moves, orbiting just scrolls this offset into it
+    self.starfield_offset = 0
 
 
     self.downstairs_location = (0,0)
     self._rooms = []
     self.room_lookup = {}
+    self.room_graph = RoomGraph()
     self.vacuum_sources = []
     self.show_debug = False
     self.vacuum_tiles = set()
+    self.generation_stats = {} # Filled in by procgen with timing/trace info
+
+  def __getstate__(self):
+    # Remembered fov results get worked out again after loading
+    state = self.__dict__.copy()
+    del state['fov_cache']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.fov_cache = OrderedDict()
 
   @property
   def rooms(self):
@@ -43,6 +74,7 @@ class GameMap:
   def rooms(self, rooms):
     self._rooms = rooms
     self.room_lookup = {}
+    self.room_graph = RoomGraph(rooms)
     self.vacuum_sources = []
     for r in rooms:
       for xy in r.coords:
@@ -51,9 +83,75 @@ class GameMap:
         self.vacuum_sources.append(r)
 
   def add_room(self, new_room):
-    new_rooms = self._rooms.copy()
-    new_rooms.append(new_room)
-    self.rooms = new_rooms
+    self._rooms = self._rooms + [new_room]
+    for xy in new_room.coords:
+      self.room_lookup[xy] = new_room
+    self.room_graph.add_room(new_room)
+    if new_room.is_vacuum_source:
+      self.vacuum_sources.append(new_room)
+
+  def update_bit_codes(self):
+    """ Recompute the bit code of every tile.  Generation does this once it's done
+    moving walls around, after that use set_tile. """
+    self.bit_codes = np.asfortranarray(tile_bit_codes.get_bit_codes(tile_bit_codes.get_wall_matches(self.tiles)))
+
+  def set_tile(self, x, y, tile):
+    """ Change a single tile during play (doors, hull breaches, damaged walls...).
+    Only the bit codes around it are recomputed, and any walls whose code changed
+    get reshaped to match, so the map never needs decorating again. """
+    if not self.in_bounds(x, y):
+      # Negative indexes would quietly wrap around to the other side of the map
+      raise IndexError(f'({x}, {y}) is outside a {self.width}x{self.height} map')
+    was_transparent = self.tiles['transparent'][x, y]
+    self.tiles[x, y] = tile
+    if tile['transparent'] != was_transparent:
+      self.transparency_version += 1
+      self.lighting.tile_changed(x, y)
+    s_x, s_y, changed = tile_bit_codes.update_bit_codes(self.bit_codes, self.tiles, x, y)
+    targets = changed & tile_types.is_wall(self.tiles[s_x, s_y])
+    if tile_types.is_wall(tile):
+      # A brand new wall needs a shape even if nothing around it changed
+      targets[x - s_x.start, y - s_y.start] = True
+    if targets.any():
+      tile_bit_codes.set_wall_tiles(self.tiles, self.tile_set, self.bit_codes[s_x, s_y], targets,
+                                    origin=(s_x.start, s_y.start))
+
+  def compute_fov(self, x, y, radius, light_walls=True):
+    """ Field of view from x, y.  Nothing past radius can be seen, so only the square
+    around x, y is looked at, however big the ship is.  Returns (s_x, s_y, fov) where
+    fov covers just those slices of the map, or all of it if radius is 0 (no limit).
+
+    The last few results are remembered until a tile changes whether it can be seen
+    through, so turns where nothing moves (waiting, using items) don't redo them.
+    Shared, so don't modify what comes back. """
+    key = (x, y, radius, light_walls, self.transparency_version)
+    result = self.fov_cache.get(key)
+    if result is not None:
+      self.fov_cache.move_to_end(key)
+      return result
+    s_x, s_y = self.get_area_in_radius(x, y, radius)
+    fov = compute_fov(
+      self.tiles['transparent'][s_x, s_y],
+      (x - s_x.start, y - s_y.start),
+      radius=radius,
+      algorithm=tcod.FOV_BASIC,
+      light_walls=light_walls
+    )
+    fov.flags.writeable = False
+    result = self.fov_cache[key] = (s_x, s_y, fov)
+    if len(self.fov_cache) > fov_cache_size:
+      self.fov_cache.popitem(last=False)
+    return result
+
+  def scroll_starfield(self, distance=1):
+    self.starfield_offset = (self.starfield_offset + distance) % self.space_tiles.shape[0]
+
+  def get_starfield(self, s_x, s_y):
+    """ The starfield tiles showing through at the given slices of the map. """
+    star_width, star_height = self.space_tiles.shape
+    columns = (np.arange(s_x.start, s_x.stop) + self.starfield_offset) % star_width
+    rows = np.arange(s_y.start, s_y.stop) % star_height
+    return self.space_tiles[np.ix_(columns, rows)]
 
   def get_room_at_location(self, xy):
     return self.room_lookup.get(xy)
@@ -78,7 +176,7 @@ class GameMap:
 
 
   def reveal_map(self):
-    self.explored = np.full((self.width, self.height), fill_value=True, order="F")
+    self.explored.fill(True)
 
   def get_blocking_entity_at_location(self, location_x, location_y):
     for entity in self.entities:
@@ -106,6 +204,14 @@ class GameMap:
           coords.append((tx,ty))
     return coords
 
+  def get_area_in_radius(self, x, y, radius):
+    """ Slices of the square reaching radius out from x, y, clipped to the map.  A
+    radius of 0 means no limit. """
+    if radius <= 0:
+      return slice(0, self.width), slice(0, self.height)
+    return (slice(max(x - radius, 0), min(x + radius + 1, self.width)),
+            slice(max(y - radius, 0), min(y + radius + 1, self.height)))
+
   def get_viewport(self):
     x = self.engine.player.x
     y = self.engine.player.y
@@ -147,7 +253,14 @@ class GameMap:
     o_x, o_y, e_x, e_y = self.get_viewport()
     s_x = slice(o_x, e_x+1)
     s_y = slice(o_y,e_y+1)
-    viewport_tiles    = self.tiles[s_x,s_y]#[o_x:e_x+1,o_y:e_y + 1]
+    viewport_dark     = self.tiles['dark'][s_x,s_y].copy()#[o_x:e_x+1,o_y:e_y + 1]
+    viewport_light    = self.tiles['light'][s_x,s_y].copy()
+    # Space shows the scrolling starfield rather than whatever space tile is actually there
+    viewport_space    = self.tiles['tile_class_code'][s_x,s_y] == tile_types.TileClass.SPACE
+    if viewport_space.any():
+      stars = self.get_starfield(s_x, s_y)
+      viewport_dark[viewport_space] = stars['dark'][viewport_space]
+      viewport_light[viewport_space] = stars['light'][viewport_space]
     viewport_visible  = self.visible[s_x,s_y]
     viewport_explored = self.explored[s_x,s_y]
 
@@ -163,43 +276,29 @@ class GameMap:
     #  )
     console.tiles_rgb[0:self.engine.game_world.viewport_width, 0:self.engine.game_world.viewport_height] = np.select(
         condlist=[viewport_explored],
-        choicelist=[viewport_tiles["dark"]],
+        choicelist=[viewport_dark],
         default=tile_types.SHROUD
     )
 
     player = self.engine.player
     # Add our player light to our light map
-    light_levels = self.light_levels.copy()
-    viewport_light_levels = light_levels[s_x,s_y]
+    viewport_light_levels = self.light_levels[s_x,s_y]
     visible_light_levels = np.select(condlist=[viewport_visible], choicelist=[viewport_light_levels], default=1)
-    # Try some more dynamic lighting
-    lit = np.where(visible_light_levels < 1.0)
-    #print(lit)
-    #print(f'Player is at ({self.engine.player.x},{self.engine.player.y}).  These tile are lit: {lit}')
-
-    for i in range(len(lit[0])):
-      x, y = lit[0][i], lit[1][i]
-      brightness_diff = visible_light_levels[x][y]
-      #distance = self.engine.player.distance(x + o_x, y + o_y)
-      #brightness_diff = distance / (self.engine.player.visibility+2)
-      #print(f'({x},{y}) is lit, translated to ({x-o_x},{y-o_y}) in viewport.  Distance to player: {distance}.')
-      light_fg = viewport_tiles[x][y]['light']['fg']
-      light_bg = viewport_tiles[x][y]['light']['bg']
-      dark_fg = viewport_tiles[x][y]['dark']['fg']
-      dark_bg = viewport_tiles[x][y]['dark']['bg']
-      new_fg = []
-      new_bg = []
-      for j in range(0,3):
-        new_fg.append(light_fg[j] - int((light_fg[j] - dark_fg[j]) * brightness_diff))
-        new_bg.append(light_bg[j] - int((light_bg[j] - dark_bg[j]) * brightness_diff))
-      #print(f'Light fg:{light_fg}, bg:{light_bg}, Dark fg:{dark_fg}, bg{dark_bg}.  Multiplier: {brightness_diff}.  New fg:{new_fg}, bg:{new_bg}')
-      console.tiles_rgb['bg'][x,y] = tuple(new_bg)
-      console.tiles_rgb['fg'][x,y] = tuple(new_fg)
+    # Try some more dynamic lighting.  Lit tiles fade from their light colors towards
+    # their dark ones the dimmer they are, truncating like int() would.
+    lit = visible_light_levels < 1.0
+    if lit.any():
+      brightness_diff = visible_light_levels[lit][:, np.newaxis]
+      viewport_rgb = console.tiles_rgb[0:lit.shape[0], 0:lit.shape[1]]
+      for channel in ('fg', 'bg'):
+        light_c = viewport_light[channel][lit].astype(np.int16)
+        dark_c = viewport_dark[channel][lit].astype(np.int16)
+        viewport_rgb[channel][lit] = light_c - np.trunc((light_c - dark_c) * brightness_diff).astype(np.int16)
 
 
 
     for x,y in self.vacuum_tiles:
-      if o_x <= x <= e_x and o_y <= y <= e_y and self.explored[x,y]:
+      if o_x <= x <= e_x and o_y <= y <= e_y and viewport_explored[x-o_x,y-o_y]:
         v_x = x - o_x
         v_y = y - o_y
         r,g,b = console.tiles_rgb['bg'][v_x,v_y]
@@ -244,12 +343,21 @@ class GameMap:
     )
 
     for entity in entities_sorted_for_rendering:
-      if self.visible[entity.x, entity.y] and light_levels[entity.x][entity.y] < 1:
+      if self.visible[entity.x, entity.y] and self.light_levels[entity.x, entity.y] < 1:
         console.print(x=entity.x - o_x,
                       y=entity.y - o_y,
                       string=entity.char,
                       fg=entity.color)
 
+class FloorBuild:
+  """ A floor the pregeneration worker is building.  done is set once it's
+  finished, with the map in game_map (or None if building it failed). """
+  def __init__(self, floor, seed):
+    self.floor = floor
+    self.seed = seed
+    self.done = threading.Event()
+    self.game_map = None
+
 class GameWorld:
   """
   Holds the settings for the GameMap and generates new maps when moving down the stairs.
@@ -260,7 +368,10 @@ class GameWorld:
                engine,
                viewport_width,
                viewport_height,
-               current_floor=0):
+               current_floor=0,
+               generation_workers=0,
+               pregenerate_floors=1,
+               seed=None):
     self.engine = engine
 
 
@@ -273,9 +384,142 @@ class GameWorld:
 
 
     self.current_floor = current_floor
-
-  def generate_floor(self):
-    self.current_floor += 1
+    # Number of processes to generate ship sectors in.  0 generates them in this one.
+    self.generation_workers = generation_workers
+    # Every floor's seed is derived from this one, so a whole run can be replayed.
+    if seed is None:
+      seed = random.getrandbits(32)
+    self.seed = seed
+    # How many upcoming floors to build in the background while the current one is played.
+    self.pregenerate_floors = pregenerate_floors
+    self._init_pregeneration()
+    self._init_generation_pool()
+
+  def _init_generation_pool(self):
+    # One pool for the whole run, since starting worker processes for every floor
+    # eats most of what they save.  It's shut down along with the world.
+    self._generation_pool = None
+    self._generation_pool_finalizer = None
+    if self.generation_workers:
+      from procgen_ship import create_generation_pool
+      self._generation_pool = create_generation_pool(self.generation_workers)
+      self._generation_pool_finalizer = weakref.finalize(self, self._generation_pool.shutdown,
+                                                         wait=False, cancel_futures=True)
+
+  def shutdown(self):
+    """ Stop the generation worker processes, if there are any.  Happens on its
+    own when the world is thrown away or the game exits. """
+    if self._generation_pool_finalizer is not None:
+      self._generation_pool_finalizer()
+
+  def _init_pregeneration(self):
+    self._ready_floors = {} # (floor, seed) -> GameMap, guarded by the pregeneration lock
+    self._pregeneration_lock = threading.Lock()
+    self._pregeneration_thread = None
+    self._pregenerated_through = 0
+    self._building = None # The FloorBuild the worker is on right now, if any
+
+  def __getstate__(self):
+    # Threads, locks and processes don't pickle.  Pregenerated floors are dropped
+    # too, they come back out of the same seeds after loading.
+    state = self.__dict__.copy()
+    del state['_generation_pool']
+    del state['_generation_pool_finalizer']
+    del state['_ready_floors']
+    del state['_pregeneration_lock']
+    del state['_pregeneration_thread']
+    del state['_pregenerated_through']
+    del state['_building']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_pregeneration()
+    self._init_generation_pool()
+
+  def floor_seed(self, floor):
+    """ The seed used to generate the given floor of this run. """
+    return random.Random(f'{self.seed}:{floor}').getrandbits(32)
+
+  def generate_floor(self, seed=None):
+    """ Move on to the next floor.  Passing a seed reproduces the exact same map.
+
+    Uses the floor the background worker built if it's ready, or waits for it
+    if the worker is in the middle of building it.  Otherwise generates it right
+    here.  Either way, starts building the one after."""
+    with self._pregeneration_lock:
+      self.current_floor += 1
+      if seed is None:
+        seed = self.floor_seed(self.current_floor)
+      game_map = self._take_ready_floor(self.current_floor, seed)
+      building = self._building
+      if building is not None and (building.floor, building.seed) != (self.current_floor, seed):
+        building = None
+
+    if game_map is None and building is not None:
+      # Building it again here would only fight the worker for the GIL
+      building.done.wait()
+      game_map = building.game_map
+    if game_map is None:
+      game_map = self.build_floor(self.current_floor, seed)
+    self.engine.game_map = game_map
+    self.engine.player.place(*game_map.player_start, game_map)
+
+    self.start_pregeneration()
+
+  def _take_ready_floor(self, floor, seed):
+    """ Pull the given floor out of the ready floors, throwing away anything stale.
+    Floors further ahead are kept.  Must hold the pregeneration lock. """
+    game_map = self._ready_floors.pop((floor, seed), None)
+    for key in [key for key in self._ready_floors if key[0] <= floor]:
+      del self._ready_floors[key]
+    return game_map
+
+  def start_pregeneration(self):
+    """ Start building the upcoming floors in a background thread, if it isn't already. """
+    if self.pregenerate_floors <= 0:
+      return
+    with self._pregeneration_lock:
+      if self._pregeneration_thread is not None:
+        return
+      self._pregeneration_thread = threading.Thread(target=self._pregenerate,
+                                                    name='floor-pregeneration',
+                                                    daemon=True)
+      self._pregeneration_thread.start()
+
+  def _pregenerate(self):
+    """ Keep the next few floors built and ready, then quit. """
+    while True:
+      with self._pregeneration_lock:
+        floor = max(self.current_floor, self._pregenerated_through) + 1
+        if floor > self.current_floor + self.pregenerate_floors:
+          self._pregeneration_thread = None
+          return
+        building = self._building = FloorBuild(floor, self.floor_seed(floor))
+      try:
+        building.game_map = self.build_floor(floor, building.seed)
+      except:
+        # Anyone waiting on it just generates it themselves
+        with self._pregeneration_lock:
+          self._building = None
+          self._pregeneration_thread = None
+        building.done.set()
+        raise
+      with self._pregeneration_lock:
+        # Hand it over and store it in one go, so generate_floor always finds it one way or the other
+        self._building = None
+        building.done.set()
+        if floor <= self.current_floor:
+          # The player got there first and took it straight from the build.
+          continue
+        self._ready_floors[floor, building.seed] = building.game_map
+        self._pregenerated_through = floor
+
+  def build_floor(self, floor, seed):
+    """ Generate the map for a floor without touching the current game state.
+    The player isn't placed, their spot is in game_map.player_start. """
+    print(f'Generating floor {floor} with seed {seed}')
+    rng = random.Random(seed)
     #map_width = random.randint(self.min_map_width, int(self.min_map_width * 1.25))
     #map_height = random.randint(self.min_map_height, int(self.min_map_height * 1.25))
     #TODO: Choose different tile sets for different ship types
@@ -287,12 +531,16 @@ class GameWorld:
     #                                       engine=self.engine,
     #                                       tile_set=tile_set)
     from ships import HallShip, SphereStarShip
-    ship_class = random.choice((HallShip, SphereStarShip))
-    ship = ship_class(tile_set.copy())
+    ship_class = rng.choice((HallShip, SphereStarShip))
+    ship = ship_class(tile_set.copy(), rng)
     #import pdb; pdb.set_trace()
     from procgen_ship import generate_dungeon
-    self.engine.game_map = generate_dungeon(self.engine, ship)
-    return
+    game_map = generate_dungeon(self.engine, ship,
+                                pool=self._generation_pool,
+                                floor_number=floor,
+                                place_player=False)
+    game_map.seed = seed
+    return game_map
 
     #from procgen import generate_dungeon
 
@@ -0,0 +1,75 @@
+import numpy as np
+
+from chunks import ChunkedGrid
+from components.light_source import get_light_kernel
+
+def compute_light(game_map, x, y, radius, light_walls=True):
+  """ Light cast by a light of the given radius at x, y.  Returns (s_x, s_y, light
+  levels) where the levels cover just the slices of the map the light can reach.
+  A light with no radius only lights its own tile. """
+  if radius <= 0:
+    # A radius of 0 means no limit to fov, which is the opposite of what we want here
+    return slice(x, x + 1), slice(y, y + 1), np.zeros((1, 1))
+  # Nothing past the light's radius gets lit, so the fov only covers that square
+  s_x, s_y, light_fov = game_map.compute_fov(x, y, radius, light_walls)
+  # Line the light's falloff up with the square, cutting off whatever hangs off the map
+  k_x, k_y = s_x.start - x + radius, s_y.start - y + radius
+  falloff = get_light_kernel(radius)[k_x:k_x + light_fov.shape[0], k_y:k_y + light_fov.shape[1]]
+  return s_x, s_y, np.where(light_fov, falloff, 1.0)
+
+class Lighting:
+  """
+  Keeps track of the light from every light on a map except the player.
+
+  Those lights hardly ever change, so each one's light is only worked out when it
+  first shows up, moves, or a tile within its reach changes how see-through it is
+  (a door opening, a hull breach...).  All of them together are kept as one layer
+  that's only put back together when one of them changes, so having lots of lights
+  costs nothing from turn to turn.
+  """
+  def __init__(self, game_map):
+    self.game_map = game_map
+    self.layers = {} # (light, light_walls) -> ((x, y, radius), s_x, s_y, light levels)
+    self.combined = None
+    self.combined_key = None
+
+  def __getstate__(self):
+    # All of this gets rebuilt the first time it's needed
+    state = self.__dict__.copy()
+    state['layers'] = {}
+    state['combined'] = None
+    state['combined_key'] = None
+    return state
+
+  def get_layer(self, light, light_walls):
+    key = (light, light_walls)
+    placement = (light.x, light.y, light.light_source.radius)
+    layer = self.layers.get(key)
+    if layer is None or layer[0] != placement:
+      layer = self.layers[key] = (placement,) + compute_light(self.game_map, *placement, light_walls)
+      self.combined = None
+    return layer
+
+  def tile_changed(self, x, y):
+    """ Forget the light of anything that reaches x, y.  Call this whenever a tile
+    changes whether you can see through it. """
+    for key, (_, s_x, s_y, _) in list(self.layers.items()):
+      if s_x.start <= x < s_x.stop and s_y.start <= y < s_y.stop:
+        del self.layers[key]
+        self.combined = None
+
+  def get_static_light_levels(self, lights):
+    """ Light levels from all the given lights together, as a ChunkedGrid.  lights
+    is a list of (light, light_walls), since lights out of the player's sight don't
+    light up walls.  Shared, so copy it before changing it. """
+    layers = [self.get_layer(light, light_walls) for light, light_walls in lights]
+    key = tuple(lights)
+    if self.combined is None or self.combined_key != key:
+      # Lights that stop being used can be forgotten
+      for unused in self.layers.keys() - set(lights):
+        del self.layers[unused]
+      self.combined = ChunkedGrid((self.game_map.width, self.game_map.height), fill_value=1.0, dtype=float)
+      for _, s_x, s_y, light_levels in layers:
+        self.combined[s_x, s_y] = np.minimum(self.combined[s_x, s_y], light_levels)
+      self.combined_key = key
+    return self.combined
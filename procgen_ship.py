@@ -2,14 +2,19 @@ import random
 import tcod
 import numpy as np
 import json
-import math
+import time
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 import entity_factories
 from game_map import GameMap
 import tile_types
-from wfc import get_wfc, Tile, get_tile_sides
-from brushes import load_brushes
-from rooms import Room
+from tile_types import TileClass
+from wfc import get_wfc
+from tile_plans import find_doorways, get_disc_mask, label_regions
+from brushes import load_brushes, get_compiled_rules
+from rooms import Room, RoomLabels
 from ships import SectorPurpose
 
 max_items_by_floor = [
@@ -68,7 +73,7 @@ def get_max_value_for_floor(max_value_by_floor, floor):
       current_value = value
   return current_value
 
-def get_entities_at_random(weighted_chances_by_floor, number_of_entities, floor):
+def get_entities_at_random(weighted_chances_by_floor, number_of_entities, floor, rng=random):
   entity_weighted_chances = {}
   for key, values in weighted_chances_by_floor.items():
     if key > floor:
@@ -82,7 +87,7 @@ def get_entities_at_random(weighted_chances_by_floor, number_of_entities, floor)
   entities = list(entity_weighted_chances.keys())
   entity_weighted_chance_values = list(entity_weighted_chances.values())
 
-  chosen_entities = random.choices(
+  chosen_entities = rng.choices(
     entities, weights=entity_weighted_chance_values, k=number_of_entities
   )
 
@@ -90,14 +95,14 @@ def get_entities_at_random(weighted_chances_by_floor, number_of_entities, floor)
 
 
 
-def place_entities(room, dungeon, floor_number):
-  number_of_monsters = random.randint(0, get_max_value_for_floor(max_monsters_by_floor, floor_number))
-  number_of_items = random.randint(0, get_max_value_for_floor(max_items_by_floor, floor_number))
+def place_entities(room, dungeon, floor_number, rng=random):
+  number_of_monsters = rng.randint(0, get_max_value_for_floor(max_monsters_by_floor, floor_number))
+  number_of_items = rng.randint(0, get_max_value_for_floor(max_items_by_floor, floor_number))
 
-  monsters = get_entities_at_random(enemy_chances, number_of_monsters, floor_number)
-  items = get_entities_at_random(item_chances, number_of_items, floor_number)
+  monsters = get_entities_at_random(enemy_chances, number_of_monsters, floor_number, rng)
+  items = get_entities_at_random(item_chances, number_of_items, floor_number, rng)
   for entity in monsters + items:
-    x,y = random.choice(list(room.coords))
+    x,y = rng.choice(list(room.coords))
 
     if not any(entity.x == x and entity.y == y for entity in dungeon.entities):
       entity.spawn(dungeon, x, y)
@@ -164,60 +169,54 @@ def subdivide(x, y, width, height, num_times):
 
 
 def find_rooms(dungeon):
+  """ Break the map up into rooms:  every patch of floor/space tiles joined up
+  without going through a wall or door. """
   tiles = dungeon.tiles
-  processed = set()
-  rooms = []
-  for x in range(len(tiles)):
-    for y in range(len(tiles[0])):
-      coord = (x,y)
-      if coord not in processed:
-        processed.add(coord)
-        if tiles[x,y]['tile_class'] in ('floor', 'space'):
-          room_coords, wall_coords, exit_coords = flood_room(tiles, x, y)
-          # Nuke rooms that are nothing but space tiles
-          has_floors = False
-          for x, y in room_coords:
-            if tiles[x,y]['tile_class'] == 'floor':
-              has_floors = True
-              break
-          if not has_floors:
-            for x, y in room_coords:
-              tiles[x,y] = dungeon.tile_set.get_tile_type('wall', 'basic')
-          else:
-            room = Room(room_coords, wall_coords, exit_coords)
-            rooms.append(room)
-
-          processed.update(room_coords)
-          processed.update(exit_coords)
-          processed.update(wall_coords)
-  for i, room1 in enumerate(rooms,start=1):
-    for room2 in rooms[i:]:
-      room1.connect_if_able(room2)
-  return rooms
-
-def flood_room(tiles, x, y,processed=None, tile_classes=['floor','space']):
+  open_tiles = tile_types.is_tile_class(tiles, TileClass.FLOOR, TileClass.SPACE)
+  labels, count = label_regions(open_tiles)
+
+  # Nuke rooms that are nothing but space tiles
+  has_floors = np.full(count + 1, False)
+  has_floors[labels[tile_types.is_floor(tiles)]] = True
+  nuked = open_tiles & ~has_floors[labels]
+  if nuked.any():
+    tiles[nuked] = dungeon.tile_set.get_tile_types('wall', 'basic', np.count_nonzero(nuked))
+    # Renumber what's left so the labels stay 1 to count
+    renumber = np.cumsum(has_floors).astype(np.int32)
+    renumber[~has_floors] = 0
+    labels = renumber[labels]
+    count = int(np.count_nonzero(has_floors))
+
+  # Rooms get joined up by dungeon.room_graph once they're set on the map
+  room_labels = RoomLabels(labels, count, tiles['tile_class_code'], TileClass.WALL, TileClass.DOOR)
+  return room_labels.get_rooms()
+
+def flood_room(tiles, x, y,processed=None, tile_classes=(TileClass.FLOOR, TileClass.SPACE)):
+  """ Find the room x, y is in by flooding out from it.  Returns the room's
+  (coords, walls, exits).  find_rooms does the whole map at once, this is for
+  finding a single new room after the map has changed. """
   if not processed:
     processed = set()
+  tile_class_codes = tiles['tile_class_code']
+  width, height = tile_class_codes.shape
   walls = set()
   exits = set()
   processed.add((x,y))
-  for d_x,d_y in cardinal_directions.values():
-    t_x = x + d_x
-    t_y = y + d_y
-    if (t_x, t_y) not in processed:
-      try:
-        if tiles[t_x,t_y]['tile_class'] in tile_classes:
-          new_processed, new_walls, new_exits = flood_room(tiles, t_x,t_y, processed, tile_classes)
-          processed.update(new_processed)
-          exits.update(new_exits)
-          walls.update(new_walls)
-        elif tiles[t_x,t_y]['tile_class'] == 'door':
+  to_check = [(x,y)]
+  while to_check:
+    x, y = to_check.pop()
+    for d_x,d_y in cardinal_directions.values():
+      t_x = x + d_x
+      t_y = y + d_y
+      if (t_x, t_y) not in processed and 0 <= t_x < width and 0 <= t_y < height:
+        tile_class = tile_class_codes[t_x,t_y]
+        if tile_class in tile_classes:
+          processed.add((t_x,t_y))
+          to_check.append((t_x,t_y))
+        elif tile_class == TileClass.DOOR:
           exits.add((t_x,t_y))
-        elif tiles[t_x,t_y]['tile_class'] == 'wall':
+        elif tile_class == TileClass.WALL:
           walls.add((t_x,t_y))
-      except IndexError:
-        # Cheaper to do this when nearing an edge than doing an if check every loop
-        pass
   return processed, walls, exits
 
 def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
@@ -226,9 +225,9 @@ def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
       and all walls are 500.  Pathfinding will avoid walls as long as possible,
       until the cost to go through a wall are so high it has no choice.
       Then we'll use that path to find any walls and build traversable spaces."""
-  tile_classes = np.array(dungeon.tiles['tile_class'])
+  tile_classes = dungeon.tiles['tile_class_code']
   space_weight = np.full((dungeon.width, dungeon.height), fill_value=999, dtype=int)
-  cost = np.select([tile_classes=='door', tile_classes=='floor',tile_classes=='space'],
+  cost = np.select([tile_classes==TileClass.DOOR, tile_classes==TileClass.FLOOR,tile_classes==TileClass.SPACE],
                    [np.ones((dungeon.width,dungeon.height),dtype=int),np.ones((dungeon.width,dungeon.height),dtype=int),space_weight],
                    default=500)
 
@@ -253,9 +252,9 @@ def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
 
     if path_room and path_room not in pathed_to:
       # First time hitting this room.  Assume all connected rooms are accessible from here
-      connected_rooms = path_room.get_all_connections()
+      connected_rooms = dungeon.room_graph.get_component(path_room)
       pathed_to.update(connected_rooms)
-    elif dungeon.tiles[x,y]['tile_class'] == 'wall': # If this isn't a room, check to see if it's a wall
+    elif tile_types.is_wall(dungeon.tiles[x,y]): # If this isn't a room, check to see if it's a wall
       # First check to see if this is just a 1 tile wide wall
       previous_xy = path[i-1]
       source_room = dungeon.room_lookup.get(previous_xy)
@@ -265,9 +264,8 @@ def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
         # Simple, add a door between them and connect them.
         #print(f'Adding simple door at ({x},{y})')
         dungeon.tiles[x,y] = tile_set.get_tile_type('door')
-        source_room.exits.add((x,y))
-        next_room.exits.add((x,y))
-        source_room.connect_if_able(next_room)
+        dungeon.room_graph.add_exit(source_room, (x,y))
+        dungeon.room_graph.add_exit(next_room, (x,y))
       else:
         # OK, deal with a longer tunnel.
         if source_room:
@@ -286,30 +284,28 @@ def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
             continue
           #print(f'Placing starting door at ({first_exit_x}, {first_exit_y})')
           dungeon.tiles[first_exit_x, first_exit_y] = tile_set.get_tile_type('door')
-          last_room.exits.add((first_exit_x, first_exit_y))
+          dungeon.room_graph.add_exit(last_room, (first_exit_x, first_exit_y))
           if len(new_tunnel) == 0:
             #print(f'Short tunnel detected near ({first_exit_x},{first_exit_y})')
             # We are only a 2 long "tunnel" one of which is now a door, so just add ourselves
             # to the next room and connect the two rooms
             dungeon.tiles[x,y] = tile_set.get_tile_type('floor','basic')
-            next_room.exits.add((first_exit_x, first_exit_y))
+            dungeon.room_graph.add_exit(next_room, (first_exit_x, first_exit_y))
             next_room.coords.add((x,y))
-            next_room.connect_if_able(last_room)
           else:
             # Create an actual tunnel
             # Add this tile as an exit to the next room
             #print(f'Placing ending door at ({x}, {y})')
             dungeon.tiles[x,y] = tile_set.get_tile_type('door')
-            next_room.exits.add((x,y))
+            dungeon.room_graph.add_exit(next_room, (x,y))
 
-            for t_x,t_y in new_tunnel:
-              dungeon.tiles[t_x,t_y] = tile_set.get_tile_type('floor','basic')
+            t_xs, t_ys = zip(*new_tunnel)
+            dungeon.tiles[t_xs, t_ys] = tile_set.get_tile_types('floor', 'basic', len(new_tunnel))
 
             # Turn the newly formed tunnel into a bonafide room
-            processed, walls, exits = flood_room(dungeon.tiles, previous_xy[0], previous_xy[1], tile_classes=['floor'])
+            processed, walls, exits = flood_room(dungeon.tiles, previous_xy[0], previous_xy[1], tile_classes=(TileClass.FLOOR,))
+            # Adding it joins it to last_room and next_room through its doors
             new_room = Room(processed, walls, exits)
-            new_room.connect_if_able(last_room)
-            new_room.connect_if_able(next_room)
             pathed_to.add(new_room)
             dungeon.add_room(new_room)
 
@@ -320,273 +316,295 @@ def create_path_between(dungeon, tile_set, src_x, src_y, dest_x, dest_y):
   return pathed_to
 
 
+def create_generation_pool(workers):
+  """A process pool for generate_dungeon to run sector WFC in.  Meant to be made
+  once and kept around, since starting the processes costs more than a small
+  floor's WFC.  Workers are spawned rather than forked, so it's safe to use from
+  the floor pregeneration thread while other threads hold locks."""
+  return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def plan_sector(rules, plan_width, plan_height, seed):
+  """Run WFC for a single sector.  Lives at the module level so worker processes can call it."""
+  wfc_stats = {}
+  tile_plan = np.array(get_wfc(rules=rules, width=plan_width, height=plan_height, stats=wfc_stats, seed=seed))
+  return tile_plan, wfc_stats
+
+# What each value in a WFC tile plan gets stamped onto the map as
+plan_tile_classes = {-1: ('space', 'basic'),
+                     0: ('wall', 'basic'),
+                     255: ('floor', 'basic'),
+                     3: ('door', None)}
+
+@contextmanager
+def generation_stage(dungeon, name):
+  """Time a stage of the generation pipeline into dungeon.generation_stats['stages']."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    stages = dungeon.generation_stats.setdefault('stages', {})
+    stages[name] = stages.get(name, 0) + time.perf_counter() - start
+
+def stamp_tile_plan(dungeon, tile_set, tile_plan, offset_x, offset_y, np_rng):
+  """Turn a tile plan into actual tiles on the map.  Plan rows run along the
+  map's y axis, so plan[y,x] lands on tiles[x + offset_x, y + offset_y].
+  Each kind of tile is drawn in a single batch."""
+  plan = tile_plan.T
+  region = (slice(offset_x, offset_x + plan.shape[0]), slice(offset_y, offset_y + plan.shape[1]))
+  stamped = dungeon.tiles[region]
+  for plan_type, (tile_class, tile_subclass) in plan_tile_classes.items():
+    mask = plan == plan_type
+    count = np.count_nonzero(mask)
+    if count:
+      stamped[mask] = tile_set.get_tile_types(tile_class, tile_subclass, count, np_rng)
+  dungeon.tiles[region] = stamped
+
 def generate_dungeon(engine,
-                     ship):
+                     ship,
+                     pool=None,
+                     floor_number=None,
+                     place_player=True):
+  """Build a GameMap for a ship.  If pool is given (see create_generation_pool),
+  the WFC runs for each sector are farmed out to it.
+
+  The player's starting spot is always kept in dungeon.player_start.  Pass
+  place_player=False to leave the player alone (eg. when building the map
+  on a background thread) and place them once the map is swapped in."""
   player = engine.player
+  rng = ship.rng
+  if floor_number is None:
+    floor_number = engine.game_world.current_floor
 
-  dungeon = GameMap(engine, ship, entities=[player])
+  dungeon = GameMap(engine, ship, entities=[player] if place_player else ())
   print(f'Dungeon size: ({len(dungeon.tiles)}, {len(dungeon.tiles[0])})')
 
-  ship.pre_gen(dungeon.tiles)
+  with generation_stage(dungeon, 'pre_gen'):
+    ship.pre_gen(dungeon.tiles)
 
+  # Every sector gets its own seed up front, so its plan comes out the same
+  # whether it's generated here or over in a worker process.
+  sector_jobs = []
   for sector in ship.sectors:
     brush_set = sector.brush_set
-    tile_set  = sector.tile_set
+    tile_size = brush_set.brush_size
+    # Make sure the mini-map we generate is evenly divisibly by our tile size.
+    # Leftover space will be filled with walls
+    plan_width = sector.width // (tile_size)
+    plan_height = sector.height // (tile_size)
+    sector_jobs.append((get_compiled_rules(brush_set), plan_width, plan_height, rng.getrandbits(32)))
+
+  # Bulk tile draws come out of numpy, seeded off the ship so they're reproducible too
+  np_rng = np.random.default_rng(rng.getrandbits(64))
 
-    tiles = []
-    for b in brush_set.list_brushes():
-      brush = b['brush']
-      weight = b['weight']
-      for data in brush.get_all_rotations():
-        sides = get_tile_sides(data, brush.size)
-        #print(data, sides)
-        tiles.append(Tile(data,sides,weight))
+  # Here's the actual Wave Function Collapse call that creates our tile plans
+  with generation_stage(dungeon, 'wfc'):
+    if pool is not None:
+      sector_plans = list(pool.map(plan_sector, *zip(*sector_jobs)))
+    else:
+      sector_plans = [plan_sector(*job) for job in sector_jobs]
+
+  for sector, sector_job, (tile_plan, wfc_stats) in zip(ship.sectors, sector_jobs, sector_plans):
+    tile_set  = sector.tile_set
+    rules, plan_width, plan_height, seed = sector_job
 
     sector_x1, sector_y1 = sector.x, sector.y
-    sector_x2, sector_y2 = sector.x + sector.width - 1, sector.y + sector.height -1
     offset_x, offset_y = sector_x1, sector_y1
     width = sector.width
     height = sector.height
-
-    tile_size = brush_set.brush_size
-    # Make sure the mini-map we generate is evenly divisibly by our tile size.
-    # Leftover space will be filled with walls
-    plan_width = width // (tile_size)
-    plan_height = height // (tile_size)
-    # Here's the actual Wave Function Collapse call that creates our tile plan
-    tile_plan = np.array(get_wfc(tiles=tiles, tile_size=tile_size, width=plan_width, height=plan_height))
     #print(tile_plan)
     print(f'Plan: ({plan_width}, {plan_height}), Rendered plan:  ({len(tile_plan[0])} {len(tile_plan)}), Sector: ({sector_x1},{sector_y1})({width},{height})')
+    # benchmark.py works out how much the selection time saves over the old full-grid
+    # scan for each sector, without timing the old scan here during generation
+    print(f'WFC trace: {wfc_stats["collapses"]} collapses, {wfc_stats["backtracks"]} backtracks, '
+          f'{wfc_stats["local_restarts"]} local restarts, {wfc_stats["restarts"]} restarts, '
+          f'cell selection took {wfc_stats["select_time"]:.4f}s')
+    dungeon.generation_stats.setdefault('sectors', []).append(wfc_stats)
     #print(f'Map: ({map_width},{map_height}), Actual Map: ({len(dungeon.tiles)},{len(dungeon.tiles[0])})')
     rendered_width = len(tile_plan)
     rendered_height = len(tile_plan[0])
 
     # Here we just put a wall around the whole sector.
-    for x in range(rendered_width):
-      tile_plan[x,0] = 0
-      tile_plan[x, rendered_height - 1] = 0
-    for y in range(rendered_height):
-      tile_plan[0,y] = 0
-      tile_plan[rendered_width - 1, y] = 0
+    tile_plan[:, 0] = 0
+    tile_plan[:, -1] = 0
+    tile_plan[0, :] = 0
+    tile_plan[-1, :] = 0
 
     # The tile_plan is just a bunch of values, either 0 (wall) or 255 (floor), which we will later
     # use to generate the actual map.  But first lets look for things that look like doorways or
     # hall ends and put a placeholder value for doors in.
-    for x in range(rendered_width):
-      for y in range(rendered_height):
-        if 0 < x < rendered_width-1 and 0 < y < rendered_height-1 and tile_plan[x,y] == 255:
-          # This is a "floor" in bounds inside the outer wall we built
-          #print(f'({x},{y})')
-          # Check to see if this should be a doorway:
-          if tile_plan[x-1,y] == 0 and tile_plan[x+1,y] == 0 and \
-             tile_plan[x,y-1] == 255 and tile_plan[x,y+1] == 255:
-            # possible vertical door.  Make sure at least one side
-            # has open space so we're not filling hallways with doors
-            if tile_plan[x-1,y-1] == 255 or tile_plan[x+1,y-1] == 255 or \
-               tile_plan[x+1,y+1] == 255 or tile_plan[x-1,y+1] == 255:
-              try:
-                if tile_plan[x, y+2] == 0 or tile_plan[x,y-2] == 0:
-                  # If there's a wall right after the floor, assume we're in a turning
-                  # hallway or some other narrow space that doesn't need a door
-                  continue
-                else:
-                  # Flag this is a door
-                  tile_plan[x,y] = 3
-              except IndexError:
-                # If we're that close to the edge, don't bother with a door.
-                pass
-          elif tile_plan[x,y-1] == 0 and tile_plan[x,y+1] == 0 and \
-               tile_plan[x-1,y] == 255 and tile_plan[x+1,y] == 255:
-            # Possible horizontal door
-            if tile_plan[x-1,y-1] == 255 or tile_plan[x+1,y-1] == 255 or \
-               tile_plan[x+1,y+1] == 255 or tile_plan[x-1,y+1] == 255:
-              try:
-                if tile_plan[x+2,y] == 0 or tile_plan[x-2,y] == 0:
-                  continue
-                else:
-                  # Flag this is a door
-                  tile_plan[x,y] = 3
-              except IndexError:
-                pass
+    tile_plan[find_doorways(tile_plan)] = 3
 
     if sector.is_destroyed:
       print('Things are blowing up!')
       # Might be stupid to do this after doing all the work above, but it probably gets better/more realistic results
       hole_radius = (rendered_width < rendered_height and rendered_width // 2 or rendered_height // 2) - 4
-      center_x = rendered_width // 2
-      center_y = rendered_height // 2
-      for x in range(rendered_width):
-        for y in range(rendered_height):
-          if math.sqrt((center_x - x) ** 2 + (center_y - y) **2) <= hole_radius or random.random() <= .5:
-            tile_plan[x,y] = -1
+      in_hole = get_disc_mask(rendered_width, rendered_height, hole_radius)
+      tile_plan[in_hole | (np_rng.random(tile_plan.shape) <= .5)] = -1
 
     #print('\n'.join([''.join(str(c) for c in r) for r in tile_plan.tolist()]))
-    for x in range(0,rendered_height):
-      for y in range(0,rendered_width):
-        #print(f'({x},{y}), plan:  ({len(tile_plan[0])} {len(tile_plan)}), Map: ({map_width},{map_height})')
-        plan_type = tile_plan[y,x]
-        map_x = x + offset_x#* 3
-        map_y = y + offset_y#* 3
-        #print(f'pulling {plan_type} from ({x},{y}), placing in map at ({map_x},{map_y})')
-        if plan_type == -1:
-          dungeon.tiles[map_x, map_y] = tile_set.get_tile_type('space', 'basic')
-        if plan_type == 0:
-          dungeon.tiles[map_x,map_y] = tile_set.get_tile_type('wall', 'basic')
-        elif plan_type == 255:
-          dungeon.tiles[map_x,map_y] = tile_set.get_tile_type('floor', 'basic')
-        elif plan_type == 3:
-          dungeon.tiles[map_x,map_y] = tile_set.get_tile_type('door')
+    with generation_stage(dungeon, 'stamp'):
+      stamp_tile_plan(dungeon, tile_set, tile_plan, offset_x, offset_y, np_rng)
 
 
 
   # Punch some holes and make some SPAAAAAAAAAAAAAAAAAAAAAAAAAAACE #
-  num_holes = random.randint(0,4)
-  #print(f'Adding {num_holes} holes')
-  for i in range(num_holes):
-    x = random.randint(0, ship.width -1)
-    y = random.randint(0, ship.height -1)
-    if not ship.is_protected(x, y):
-      dungeon.tiles[x,y] = tile_set.get_tile_type('space','basic')
-      max_hole_size = random.randint(20,80)
-      hole_tiles = set([(x,y)])
-      unprocessed = set()
-      for d_x, d_y in [(0,-1),(0,1),(-1,0),(1,0),(-1,-1),(-1,1),(-1,1),(1,1)]:
-        # Add the tiles around so we always have a starting position
-        unprocessed.add((x+d_x, y+d_y))
-      while len(hole_tiles) < max_hole_size:
-        if len(unprocessed) == 0:
-          break
-        x,y = here = unprocessed.pop()
-
-        try:
-          dungeon.tiles[x, y] = tile_set.get_tile_type('space','basic')
-        except IndexError:
-          continue
-        hole_tiles.add(here)
-        # Pick a random direction
-        for j in range(random.randint(1,4)):
-          d_x, d_y = random.choice([(0,-1),(0,1),(-1,0),(1,0)])
-          t_x = x + d_x
-          t_y = y + d_y
-          if (t_x,t_y) not in hole_tiles and (t_x,t_y) not in unprocessed and \
-             0 <= t_x < ship.width and 0 <= t_y < ship.height:
-            #print(f'Adding ({t_x},{t_y}) to unprocessed')
-            unprocessed.add((t_x, t_y))
-
-
-  ship.post_gen(dungeon.tiles)
+  with generation_stage(dungeon, 'holes'):
+    num_holes = rng.randint(0,4)
+    #print(f'Adding {num_holes} holes')
+    for i in range(num_holes):
+      x = rng.randint(0, ship.width -1)
+      y = rng.randint(0, ship.height -1)
+      if not ship.is_protected(x, y):
+        dungeon.tiles[x,y] = tile_set.get_tile_type('space','basic')
+        max_hole_size = rng.randint(20,80)
+        hole_tiles = set([(x,y)])
+        unprocessed = set()
+        for d_x, d_y in [(0,-1),(0,1),(-1,0),(1,0),(-1,-1),(-1,1),(-1,1),(1,1)]:
+          # Add the tiles around so we always have a starting position
+          unprocessed.add((x+d_x, y+d_y))
+        while len(hole_tiles) < max_hole_size:
+          if len(unprocessed) == 0:
+            break
+          x,y = here = unprocessed.pop()
 
-  # Break the map up into rooms
-  rooms = find_rooms(dungeon)
-  print(f'Found {len(rooms)} rooms!')
-  delete_rooms = []
-  for room in rooms:
-    if False:#(room.width == 1 or room.height == 1 or len(room.coords) <= 8) and len(room.exits) == 0:
-      # Delete this room
-      for x,y in room.coords:
-        dungeon.tiles[x,y] = tile_set.get_tile_type('wall','basic')
-      delete_rooms.append(room)
-      #room.color = (0,0,0)
-    else:
-      for x,y in room.coords:
-        if tile_set.is_tile_class(dungeon.tiles[x,y], 'space'):
-          room.is_vacuum_source = True
-          break
-  for room in delete_rooms:
-    rooms.remove(room)
+          try:
+            dungeon.tiles[x, y] = tile_set.get_tile_type('space','basic')
+          except IndexError:
+            continue
+          hole_tiles.add(here)
+          # Pick a random direction
+          for j in range(rng.randint(1,4)):
+            d_x, d_y = rng.choice([(0,-1),(0,1),(-1,0),(1,0)])
+            t_x = x + d_x
+            t_y = y + d_y
+            if (t_x,t_y) not in hole_tiles and (t_x,t_y) not in unprocessed and \
+               0 <= t_x < ship.width and 0 <= t_y < ship.height:
+              #print(f'Adding ({t_x},{t_y}) to unprocessed')
+              unprocessed.add((t_x, t_y))
 
-  dungeon.rooms = rooms
 
-  # Let's connect some rooms!
-  for room in rooms:
-    #print('Checking room for exits....')
-    num_exits = len(room.exits)
-    if num_exits <= 1:
-      walls = list(room.walls)
-      random.shuffle(walls)
-      # If a room has an exits, add between 0 and 1 more
-      # If a room has no exits, add between 1 and 2
-      exits_needed = random.randint(1 - num_exits,2 - num_exits)
-      exits_added = 0
-      for wall in walls:
-        wall_x, wall_y = wall
-        # Certain ship plans set aside pregen areas, so don't touch them
-        if not ship.is_protected(wall_x, wall_y):
-          # Try not to place 2 doors next to each other.
-          is_door_adjacent = False
-          for door_x,door_y in ((1,0),(-1,0),(0,1),(0,-1)):
-            try:
-              if dungeon.tiles[wall_x+door_x,wall_y+door_y]['tile_class'] == 'door':
-                is_door_adjacent = True
-                break
-            except IndexError:
-              pass
-          if is_door_adjacent:
-            #print('Skipping wall segment next to a door.')
-            continue
+  with generation_stage(dungeon, 'post_gen'):
+    ship.post_gen(dungeon.tiles)
 
-          for d_x,d_y in ((1,0),(-1,0),(0,1),(0,-1)):
-            t_x = wall_x + d_x
-            t_y = wall_y + d_y# Prevent two doors next to each other
+  # Break the map up into rooms
+  with generation_stage(dungeon, 'rooms'):
+    rooms = find_rooms(dungeon)
+    print(f'Found {len(rooms)} rooms!')
+    delete_rooms = []
+    space = tile_types.is_space(dungeon.tiles)
+    for room in rooms:
+      if False:#(room.width == 1 or room.height == 1 or len(room.coords) <= 8) and len(room.exits) == 0:
+        # Delete this room
+        for x,y in room.coords:
+          dungeon.tiles[x,y] = tile_set.get_tile_type('wall','basic')
+        delete_rooms.append(room)
+        #room.color = (0,0,0)
+      else:
+        for x,y in room.coords:
+          if space[x,y]:
+            room.is_vacuum_source = True
+            break
+    for room in delete_rooms:
+      rooms.remove(room)
 
-            other_room = dungeon.room_lookup.get((t_x, t_y))
+    dungeon.rooms = rooms
 
-            #print(f'Checking other room at ({t_x},{t_y}) which is a {other_room} and is self? {other_room == room}')
-            if other_room is not None and other_room != room:
-              #print('Creating exit!')
-              dungeon.tiles[wall_x,wall_y] = tile_set.get_tile_type('door', 'closed')
-              room.exits.add(wall)
-              #print(f'Walls: {room.walls}, wall: {wall})')
-              try:
-                room.walls.remove(wall)
-              except KeyError:
-                pass
-              other_room.exits.add(wall)
+  # Let's connect some rooms!
+  with generation_stage(dungeon, 'connect'):
+    for room in rooms:
+      #print('Checking room for exits....')
+      num_exits = len(room.exits)
+      if num_exits <= 1:
+        walls = list(room.walls)
+        rng.shuffle(walls)
+        # If a room has an exits, add between 0 and 1 more
+        # If a room has no exits, add between 1 and 2
+        exits_needed = rng.randint(1 - num_exits,2 - num_exits)
+        exits_added = 0
+        for wall in walls:
+          wall_x, wall_y = wall
+          # Certain ship plans set aside pregen areas, so don't touch them
+          if not ship.is_protected(wall_x, wall_y):
+            # Try not to place 2 doors next to each other.
+            is_door_adjacent = False
+            for door_x,door_y in ((1,0),(-1,0),(0,1),(0,-1)):
               try:
-                other_room.walls.remove(wall)
-              except KeyError:
+                if tile_types.is_door(dungeon.tiles[wall_x+door_x,wall_y+door_y]):
+                  is_door_adjacent = True
+                  break
+              except IndexError:
                 pass
-              room.connect_if_able(other_room)
-              exits_added += 1
+            if is_door_adjacent:
+              #print('Skipping wall segment next to a door.')
+              continue
+
+            for d_x,d_y in ((1,0),(-1,0),(0,1),(0,-1)):
+              t_x = wall_x + d_x
+              t_y = wall_y + d_y# Prevent two doors next to each other
+
+              other_room = dungeon.room_lookup.get((t_x, t_y))
+
+              #print(f'Checking other room at ({t_x},{t_y}) which is a {other_room} and is self? {other_room == room}')
+              if other_room is not None and other_room != room:
+                #print('Creating exit!')
+                dungeon.tiles[wall_x,wall_y] = tile_set.get_tile_type('door', 'closed')
+                dungeon.room_graph.add_exit(room, wall)
+                #print(f'Walls: {room.walls}, wall: {wall})')
+                try:
+                  room.walls.remove(wall)
+                except KeyError:
+                  pass
+                dungeon.room_graph.add_exit(other_room, wall)
+                try:
+                  other_room.walls.remove(wall)
+                except KeyError:
+                  pass
+                exits_added += 1
+              if exits_added >= exits_needed :
+                break
             if exits_added >= exits_needed :
               break
-          if exits_added >= exits_needed :
-            break
 
   # Don't spawn in a vacuum or start the stairs in one
   # We may want to only start in a clean room to start, then
   # always start in a breached room as we crash into the new ship?
-  clean_room_list = []
-  for r in list(rooms):
-    if not r.is_vacuum_source:
-      clean_room_list.append(r)
-  random.shuffle(clean_room_list)
-  fourths = len(clean_room_list) // 4
-  starting_room = random.choice(clean_room_list[:fourths])
-  starting_x, starting_y = random.choice(list(starting_room.coords))
-  player.place(starting_x,starting_y,dungeon)
-  for exit_x, exit_y in starting_room.exits:
-    # Close all the doors
-    dungeon.tiles[exit_x, exit_y] = tile_set.get_tile_type('door', 'closed')
-
-  end_room = random.choice(clean_room_list[fourths * 3:])
-  end_x, end_y = random.choice(list(end_room.coords))
-  dungeon.tiles[end_x,end_y] = tile_set.get_tile_type('interactable', 'exit')
-  dungeon.downstairs_location = (end_x,end_y)
+  with generation_stage(dungeon, 'placement'):
+    clean_room_list = []
+    for r in list(rooms):
+      if not r.is_vacuum_source:
+        clean_room_list.append(r)
+    rng.shuffle(clean_room_list)
+    fourths = len(clean_room_list) // 4
+    starting_room = rng.choice(clean_room_list[:fourths])
+    starting_x, starting_y = rng.choice(list(starting_room.coords))
+    dungeon.player_start = (starting_x, starting_y)
+    if place_player:
+      player.place(starting_x,starting_y,dungeon)
+    for exit_x, exit_y in starting_room.exits:
+      # Close all the doors
+      dungeon.tiles[exit_x, exit_y] = tile_set.get_tile_type('door', 'closed')
+
+    end_room = rng.choice(clean_room_list[fourths * 3:])
+    end_x, end_y = rng.choice(list(end_room.coords))
+    dungeon.tiles[end_x,end_y] = tile_set.get_tile_type('interactable', 'exit')
+    dungeon.downstairs_location = (end_x,end_y)
 
 
 
   # this makes sure we can traverse to every room in the ship.
-  pathed_to = set([starting_room])
-  for room in rooms:
-    #print(f'{len(pathed_to)} rooms checked.')
-    if room not in pathed_to:
-      dest_x, dest_y = random.choice(list(room.coords))
-      pathed_to.update(create_path_between(dungeon, tile_set, starting_x, starting_y, dest_x, dest_y))
-
-  ship.decorate(dungeon)
-
-  for room in list(rooms):
-    place_entities(room, dungeon, engine.game_world.current_floor)
+  with generation_stage(dungeon, 'paths'):
+    pathed_to = set([starting_room])
+    for room in rooms:
+      #print(f'{len(pathed_to)} rooms checked.')
+      if room not in pathed_to:
+        dest_x, dest_y = rng.choice(list(room.coords))
+        pathed_to.update(create_path_between(dungeon, tile_set, starting_x, starting_y, dest_x, dest_y))
+
+  with generation_stage(dungeon, 'decorate'):
+    ship.decorate(dungeon)
+
+  with generation_stage(dungeon, 'entities'):
+    for room in list(rooms):
+      place_entities(room, dungeon, floor_number, rng)
 
   return dungeon
@@ -7,6 +7,7 @@ import entity_factories
 from game_map import GameMap
 import tile_types
 from wfc import get_wfc, Tile, get_tile_sides
+from tile_plans import find_doorways
 from brushes import load_brushes
 from rooms import Room
 
@@ -364,41 +365,7 @@ def generate_dungeon(map_width,
       tile_plan[0,y] = 0
       tile_plan[rendered_width - 1, y] = 0
 
-    for x in range(rendered_width):
-      for y in range(rendered_height):
-        if 0 < x < rendered_width-1 and 0 < y < rendered_height-1 and tile_plan[x,y] == 255:
-          #print(f'({x},{y})')
-          # Check to see if this should be a doorway:
-          if tile_plan[x-1,y] == 0 and tile_plan[x+1,y] == 0 and \
-             tile_plan[x,y-1] == 255 and tile_plan[x,y+1] == 255:
-            # possible vertical door.  Make sure at least one side
-            # has open space so we're not filling hallways with doors
-            if tile_plan[x-1,y-1] == 255 or tile_plan[x+1,y-1] == 255 or \
-               tile_plan[x+1,y+1] == 255 or tile_plan[x+1,y+1] == 255:
-              try:
-                if tile_plan[x, y+2] == 0 or tile_plan[x,y-2] == 0:
-                  # If there's a wall right after the floor, assume we're in a turning
-                  # hallway or some other narrow space that doesn't need a door
-                  continue
-                else:
-                  # Flag this is a door
-                  tile_plan[x,y] = 3
-              except IndexError:
-                # If we're that close to the edge, don't bother with a door.
-                pass
-          elif tile_plan[x,y-1] == 0 and tile_plan[x,y+1] == 0 and \
-               tile_plan[x-1,y] == 255 and tile_plan[x+1,y] == 255:
-            # Possible horizontal door
-            if tile_plan[x-1,y-1] == 255 or tile_plan[x+1,y-1] == 255 or \
-               tile_plan[x+1,y+1] == 255 or tile_plan[x+1,y+1] == 255:
-              try:
-                if tile_plan[x+2,y] == 0 or tile_plan[x-2,y] == 0:
-                  continue
-                else:
-                  # Flag this is a door
-                  tile_plan[x,y] = 3
-              except IndexError:
-                pass
+    tile_plan[find_doorways(tile_plan)] = 3
 
     #print('\n'.join([''.join(str(c) for c in r) for r in tile_plan.tolist()]))
     for x in range(0,rendered_height):
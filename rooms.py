@@ -1,33 +1,90 @@
 import random
+import numpy as np
 
 # Maybe rooms should have a component system so we can add things like:
 # Rooms with no exits and a vacuum that have a breakable wall between them and another room,
 # so component would store conditional exit, maybe trigger condition that would alter map
 # and exit path
 
+class RoomLabels:
+  """ Every room on a map at once, as a grid of room numbers (0 where there's no
+  room), along with which walls and exits touch each room. """
+  def __init__(self, labels, count, tile_class_codes, wall_class, exit_class):
+    self.labels = labels
+    self.count = count
+    self.cells = self._group(*np.nonzero(labels), labels[labels > 0])
+
+    # Walls and exits are the wall/exit tiles next to a room in one of the four
+    # directions.  Pad with 0 so nothing wraps around the edges.
+    width, height = labels.shape
+    padded = np.pad(labels, 1)
+    neighbors = [padded[1 + d_x:1 + d_x + width, 1 + d_y:1 + d_y + height]
+                 for d_x, d_y in ((0,-1), (0,1), (-1,0), (1,0))]
+    self.walls = self._group_touching(tile_class_codes == wall_class, neighbors)
+    self.exits = self._group_touching(tile_class_codes == exit_class, neighbors)
+
+  def _group_touching(self, is_class, neighbors):
+    xs, ys, room_labels = [], [], []
+    for neighbor in neighbors:
+      touching = is_class & (neighbor > 0)
+      t_xs, t_ys = np.nonzero(touching)
+      xs.append(t_xs)
+      ys.append(t_ys)
+      room_labels.append(neighbor[touching])
+    return self._group(np.concatenate(xs), np.concatenate(ys), np.concatenate(room_labels))
+
+  def _group(self, xs, ys, room_labels):
+    """ Sort cells by room so each room's are one slice.  Returns (xs, ys, offsets),
+    where room n's cells are offsets[n-1]:offsets[n]. """
+    order = np.argsort(room_labels, kind='stable')
+    offsets = np.searchsorted(room_labels[order], np.arange(self.count + 1), side='right')
+    return xs[order], ys[order], offsets
+
+  def _get(self, group, label):
+    xs, ys, offsets = group
+    start, end = offsets[label - 1], offsets[label]
+    return set(zip(xs[start:end].tolist(), ys[start:end].tolist()))
+
+  def get_coords(self, label):
+    return self._get(self.cells, label)
+
+  def get_walls(self, label):
+    return self._get(self.walls, label)
+
+  def get_exits(self, label):
+    return self._get(self.exits, label)
+
+  def get_bounds(self, label):
+    """ (min_x, min_y, max_x, max_y) of a room. """
+    xs, ys, offsets = self.cells
+    start, end = offsets[label - 1], offsets[label]
+    # Cells are in x then y order, so the xs are already sorted
+    return int(xs[start]), int(ys[start:end].min()), int(xs[end - 1]), int(ys[start:end].max())
+
+  def get_rooms(self):
+    """ A Room for every label.  The rooms get their own sets, so nothing holds on
+    to the label grid once the map is built. """
+    return [Room(self.get_coords(label), self.get_walls(label), self.get_exits(label), self.get_bounds(label))
+            for label in range(1, self.count + 1)]
+
+
 class Room:
-  def __init__(self, coords, walls, exits):
-    """coords/walls/exits/connecting_rooms are all sets."""
+  def __init__(self, coords, walls, exits, bounds=None):
+    """coords/walls/exits/connecting_rooms are all sets.  bounds is (min_x, min_y,
+    max_x, max_y) if it's already known, otherwise it's worked out from coords."""
     self.coords = coords # Basically walkable tiles in this room, floors and space usually
     self.walls = walls # Usefull if we have no exits to find a wall to place a door
     self.exits = exits
     self.is_vacuum_source = False # Changed later during map creation
     self.is_vacuum = False # Changed later during map creation
+    self.prune_exits()
 
-
-    # Prune internal exits that only lead to ourselves.
-    removed = set()
-    for x,y in self.exits:
-      if ((x+1,y) in self.coords and (x-1,y) in self.coords) or \
-         ((x,y-1) in self.coords and (x,y+1) in self.coords):
-        # If both tiles along one axis are part of this room, this is
-        # an internally connected door that doesn't lead to another room,
-        # so remove it as an exit.
-        removed.add((x,y))
-    self.exits.difference_update(removed)
-
-    self.connecting_rooms = set() # Filled in later by procgen using self.connect_if_able
+    self.connecting_rooms = set() # Filled in later by the map's RoomGraph
     self.color = (random.randint(0,255),random.randint(0,255),random.randint(0,255)) # For map debugger
+    if bounds is not None:
+      self.min_x, self.min_y, self.max_x, self.max_y = bounds
+      return
+
     self.min_x = 9999
     self.max_x = 0
     self.min_y = 9999
@@ -42,6 +99,18 @@ class Room:
       if y > self.max_y:
         self.max_y = y
 
+  def prune_exits(self):
+    # Prune internal exits that only lead to ourselves.
+    removed = set()
+    for x,y in self.exits:
+      if ((x+1,y) in self.coords and (x-1,y) in self.coords) or \
+         ((x,y-1) in self.coords and (x,y+1) in self.coords):
+        # If both tiles along one axis are part of this room, this is
+        # an internally connected door that doesn't lead to another room,
+        # so remove it as an exit.
+        removed.add((x,y))
+    self.exits.difference_update(removed)
+
   @property
   def width(self):
     return self.max_x - self.min_x + 1
@@ -63,3 +132,102 @@ class Room:
         connections.add(r)
         connections.update(r.get_all_connections(connections))
     return connections
+
+
+class RoomGraph:
+  """ Rooms as nodes and the doors between them as edges.  Two rooms are joined
+  when a door is in both their exits.
+
+  Whether rooms are joined at all is kept as a union find, so asking never walks
+  through the rooms.  Which rooms you can actually get between depends on which
+  doors are open right now, so that's worked out from the door tiles when asked
+  and cached until one of them opens or closes. """
+  def __init__(self, rooms=()):
+    self.rooms = []
+    self.room_ids = {}
+    self.door_rooms = {} # Door xy -> ids of the rooms it's an exit of
+    self.edges = [] # (room id, room id, door xy)
+    self.parent = []
+    self._components = None
+    self._edge_doors = None
+    self._open_key = None
+    self._open_components = None
+    for room in rooms:
+      self.add_room(room)
+
+  def add_room(self, room):
+    room_id = len(self.rooms)
+    self.rooms.append(room)
+    self.room_ids[room] = room_id
+    self.parent.append(room_id)
+    for door in room.exits:
+      self._add_door(room_id, door)
+
+  def add_exit(self, room, door):
+    """ Make door an exit of room, joining it to any room that already has it. """
+    room.exits.add(door)
+    self._add_door(self.room_ids[room], door)
+
+  def _add_door(self, room_id, door):
+    rooms_here = self.door_rooms.setdefault(door, set())
+    if room_id in rooms_here:
+      return
+    for other_id in rooms_here:
+      self._connect(room_id, other_id, door)
+    rooms_here.add(room_id)
+
+  def _connect(self, room_id, other_id, door):
+    room, other_room = self.rooms[room_id], self.rooms[other_id]
+    room.connecting_rooms.add(other_room)
+    other_room.connecting_rooms.add(room)
+    self.edges.append((room_id, other_id, door))
+    self._edge_doors = None
+    root, other_root = self._find(self.parent, room_id), self._find(self.parent, other_id)
+    if root != other_root:
+      self.parent[other_root] = root
+      self._components = None
+
+  @staticmethod
+  def _find(parent, room_id):
+    while parent[room_id] != room_id:
+      parent[room_id] = parent[parent[room_id]]
+      room_id = parent[room_id]
+    return room_id
+
+  def component_id(self, room):
+    """ Rooms that are joined, through any number of doors, share a component id. """
+    return self._find(self.parent, self.room_ids[room])
+
+  def is_connected(self, room, other_room):
+    return self.component_id(room) == self.component_id(other_room)
+
+  def get_component(self, room):
+    """ Every room joined to room, including itself. """
+    if self._components is None:
+      self._components = {}
+      for room_id, member in enumerate(self.rooms):
+        self._components.setdefault(self._find(self.parent, room_id), set()).add(member)
+    return self._components[self.component_id(room)]
+
+  def get_reachable(self, sources, walkable):
+    """ Every room you can get to from any of the source rooms through doors that
+    are walkable (open) right now.  walkable is the map's walkable layer. """
+    if self._edge_doors is None:
+      if self.edges:
+        self._edge_doors = tuple(np.array(d) for d in zip(*(door for _, _, door in self.edges)))
+      else:
+        self._edge_doors = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+      self._open_key = None
+    is_open = walkable[self._edge_doors]
+    open_key = is_open.tobytes()
+    if open_key != self._open_key:
+      parent = list(range(len(self.rooms)))
+      for (room_id, other_id, _), door_open in zip(self.edges, is_open.tolist()):
+        if door_open:
+          root, other_root = self._find(parent, room_id), self._find(parent, other_id)
+          if root != other_root:
+            parent[other_root] = root
+      self._open_components = [self._find(parent, room_id) for room_id in range(len(self.rooms))]
+      self._open_key = open_key
+    source_components = {self._open_components[self.room_ids[room]] for room in sources}
+    return {room for room, component in zip(self.rooms, self._open_components) if component in source_components}
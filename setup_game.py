@@ -88,6 +88,8 @@ def load_game(filename):
   with open(filename, 'rb') as f:
     engine = pickle.loads(lzma.decompress(f.read()))
   assert isinstance(engine, Engine)
+  # Pregenerated floors aren't saved, start building the next one again.
+  engine.game_world.start_pregeneration()
   return engine
 
 def launch_creator():
@@ -1,10 +1,10 @@
 import random
-import math
 from enum import Enum, auto
 import numpy as np
 
 import tile_types
 import tile_bit_codes
+import tile_plans
 from brushes import load_brushes
 from entity_factories import light
 
@@ -30,19 +30,24 @@ class Sector:
     self.is_destroyed = is_destroyed
 
 class Ship:
-  def __init__(self, tile_set):
+  def __init__(self, tile_set, rng=None):
+    """ rng is the random.Random everything about this ship gets generated from.
+        Our tile set is our own copy, so it gets to share it too. """
     self.sectors = []
+    self.rng = rng if rng is not None else random.Random()
     self.tile_set = tile_set
-    self.tint = tint = (0, random.randint(0,20), random.randint(0,20))
+    tile_set.rng = self.rng
+    self.tint = tint = (0, self.rng.randint(0,20), self.rng.randint(0,20))
     #print(f'Tint: {tint}')
     # Slight palette shift to make each ship slightly different color
     for tile_type in tile_set.all_tile_types:
-      if tile_type['tile_class'] != 'space':
+      if not tile_types.is_space(tile_type):
         for l in ('dark','light'):
           old_c = tile_type[l]['bg']
           new_c = old_c[0] + tint[0], old_c[1] + tint[1], old_c[2] + tint[2]
           print(new_c)
           tile_type[l]['bg'] = new_c
+    tile_set.clear_caches()
     self.protected_zones = []
     self.setup()
 
@@ -77,86 +82,67 @@ class Ship:
     # hall with airlocks,, etc...
     pass
 
+  def fill_diagonal_gaps(self, tiles):
+    """ Wall off every spot where two walls only touch diagonally, by filling in one
+    of the two open corners at random.  Filling one can make another, so keep going
+    until there are none left. """
+    basic_wall = self.tile_set.get_tile_type('wall', 'basic')
+    np_rng = np.random.default_rng(self.rng.getrandbits(64))
+    while True:
+      walls = tile_types.is_wall(tiles)
+      falling, rising = tile_plans.find_diagonal_gaps(walls)
+      if not falling.any() and not rising.any():
+        break
+      fill = np.full(walls.shape, False)
+      # Falling gaps are open at (1,0) and (0,1), rising ones at (0,0) and (1,1)
+      xs, ys = np.nonzero(falling)
+      pick_x = np_rng.random(len(xs)) < .5
+      fill[xs + pick_x, ys + ~pick_x] = True
+      xs, ys = np.nonzero(rising)
+      pick_far = np_rng.random(len(xs)) < .5
+      fill[xs + pick_far, ys + pick_far] = True
+      tiles[fill] = basic_wall
+
   def decorate(self, dungeon):
     # Add interesting stuff to each room based on its purpose.
     # Add "wall" characters to all walls.
-    # First, process the edges of the map, since we can't pull full 3x3 grids from them
-    def set_tile_type(x, y, bit_code):
-      if bit_code != 255:
-        #print(f'{tiles} = {bit_code}')
-        subclass = tile_bit_codes.get_wall_subclass_for_bit_code(bit_code)
-        if subclass:
-          new_tile_type = self.tile_set.get_tile_type('wall', subclass)
-          if new_tile_type:
-            dungeon.tiles[x, y] = new_tile_type
-
-    basic_wall = self.tile_set.get_tile_type('wall', 'basic')
-    # An "empty" 3x3 template we can plug our partial edge slices into in order to generate a bit code for them
-    tile_template = np.array([[basic_wall,basic_wall,basic_wall],[basic_wall,basic_wall,basic_wall],[basic_wall,basic_wall,basic_wall]])
-    # Corners of the map will only be able to pull a 2x2 set of tiles
-    tiles = tile_template.copy()
-    tiles[1:3, 1:3] = dungeon.tiles[0:2,0:2]
-    bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-    set_tile_type(0,0, bit_code)
-
-    tiles = tile_template.copy()
-    tiles[0:2, 1:3] = dungeon.tiles[dungeon.width-2:dungeon.width,0:2]
-    bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-    set_tile_type(dungeon.width-1,0, bit_code)
-
-    tiles = tile_template.copy()
-    tiles[1:3, 0:2] = dungeon.tiles[0:2, dungeon.height-2:dungeon.height]
-    bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-    set_tile_type(0,dungeon.height-1, bit_code)
-
-    tiles = tile_template.copy()
-    tiles[0:2, 0:2] = dungeon.tiles[dungeon.width-2:dungeon.width, dungeon.height-2:dungeon.height]
-    bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-    set_tile_type(dungeon.width-1,dungeon.height-1, bit_code)
-
-    # Now get the edges
-    for x in range(1, dungeon.width - 1):
-      # Top and bottom first
-      tiles = tile_template.copy()
-      tiles[0:3,1:3] = dungeon.tiles[x-1:x+2, 0:2]
-      bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-      set_tile_type(x,0, bit_code)
-
-      tiles = tile_template.copy()
-      tiles[0:3,0:2] = dungeon.tiles[x-1:x+2, dungeon.height-2:dungeon.height]
-      bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-      set_tile_type(x,dungeon.height-1, bit_code)
-
-    for y in range(1, dungeon.height - 1):
-      # Now the sides
-      tiles = tile_template.copy()
-      tiles[1:3, 0:3] = dungeon.tiles[0:2, y-1:y+2]
-      bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-      set_tile_type(0,y, bit_code)
-
-      tiles = tile_template.copy()
-      tiles[0:2,0:3] = dungeon.tiles[dungeon.width-2:dungeon.width,y-1:y+2]
-      bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-      set_tile_type(dungeon.width-1, y, bit_code)
-
-    # Now all tiles in the rest of the map
-    for x in range(1, dungeon.width-1):
-      for y in range(1, dungeon.height-1):
-        if dungeon.tiles[x, y]['tile_class'] == 'wall':
-
-          tiles = dungeon.tiles[x-1:x+2, y-1:y+2]
-          bit_code = tile_bit_codes.get_tile_bit_code(tiles)
-          set_tile_type(x, y, bit_code)
-
+    # Every tile's bit code comes from which of its neighbours are walls or doors, and
+    # off the edge of the map counts as wall.
+    padded = np.pad(tile_bit_codes.get_wall_matches(dungeon.tiles), 1, constant_values=True)
+
+    # Edge tiles get a wall shape whatever they are, so one can turn into a wall and change
+    # the code of the next.  There aren't many of them, so do them one at a time: corners,
+    # then top and bottom, then the sides.
+    w, h = dungeon.width, dungeon.height
+    edges = [(0, 0), (w-1, 0), (0, h-1), (w-1, h-1)]
+    edges += [(x, y) for x in range(1, w-1) for y in (0, h-1)]
+    edges += [(x, y) for y in range(1, h-1) for x in (0, w-1)]
+    for x, y in edges:
+      bit_code = tile_bit_codes.get_padded_bit_code(padded, x, y)
+      subclass = tile_bit_codes.wall_subclass_lut[bit_code]
+      if bit_code != 255 and subclass:
+        new_tile_type = self.tile_set.get_tile_type('wall', tile_types.TileSubclass(subclass).name.lower())
+        if new_tile_type:
+          dungeon.tiles[x, y] = new_tile_type
+          padded[x+1, y+1] = True
+
+    # Walls only swap shape, never class, so the rest of the map can go all at once.  The
+    # codes are kept on the map so changes during play only need to redo their neighbours.
+    dungeon.update_bit_codes()
+    bit_codes = dungeon.bit_codes
+    targets = tile_types.is_wall(dungeon.tiles)
+    targets[[0, -1], :] = False
+    targets[:, [0, -1]] = False
+    tile_bit_codes.set_wall_tiles(dungeon.tiles, self.tile_set, bit_codes, targets)
 
 class HallShip(Ship):
 
   def setup(self):
     """ Hall Ships consist of one long hall, connecting multiple sectors. """
-    self.sector_width = (5 * random.randint(4,8)) + 2
-    self.sector_height = (5 * random.randint(4,8))
+    self.sector_width = (5 * self.rng.randint(4,8)) + 2
+    self.sector_height = (5 * self.rng.randint(4,8))
     print(f'Sector Width: {self.sector_width}, Sector height: {self.sector_height}')
-    self.ship_length_in_sectors = random.randint(2,120 // self.sector_width)
+    self.ship_length_in_sectors = self.rng.randint(2,120 // self.sector_width)
 
     self.width = self.sector_width * self.ship_length_in_sectors + 1
     if self.width < 80:
@@ -165,7 +151,7 @@ class HallShip(Ship):
 
     for i in range(self.ship_length_in_sectors):
       for y in (0,self.sector_height + 15):
-        sector_purpose = random.choice(list(SectorPurpose))
+        sector_purpose = self.rng.choice(list(SectorPurpose))
         if sector_purpose in (SectorPurpose.SCIENCE, SectorPurpose.COMMAND):
           brush_set = brush_sets.get('round')
         elif sector_purpose == SectorPurpose.ENGINEERING:
@@ -173,7 +159,7 @@ class HallShip(Ship):
         else:
           brush_set = brush_sets.get('default')
 
-        is_destroyed = random.random() <= .1
+        is_destroyed = self.rng.random() <= .1
 
         self.sectors.append(Sector(i * self.sector_width,
                                     y,
@@ -198,21 +184,21 @@ class HallShip(Ship):
       midline_x = (self.sector_width * i) + (self.sector_width // 2)
       end_x     = (self.sector_width * i) + self.sector_width
       print(f'Midline Y: {midline_y}, -3: {midline_y-3}, -20: {midline_y - 20}')
-      if random.random() < .1:
+      if self.rng.random() < .1:
         # Generate a blocked off entrance to this sector.  Pathing should create an alternate
         # route from a neighboring sector
         tiles[midline_x-1:midline_x+2, midline_y-5:midline_y-2] = self.tile_set.get_tile_type('floor', 'basic')
         tiles[midline_x-1:midline_x+2,midline_y-5] = self.tile_set.get_tile_type('wall', 'damaged')
-        tiles[midline_x + random.randint(-1,1),midline_y-4] = self.tile_set.get_tile_type('wall', 'damaged')
+        tiles[midline_x + self.rng.randint(-1,1),midline_y-4] = self.tile_set.get_tile_type('wall', 'damaged')
       else:
         tiles[midline_x-1:midline_x+2, midline_y-20:midline_y-2] = self.tile_set.get_tile_type('floor', 'basic')
 
-      if random.random() < .1:
+      if self.rng.random() < .1:
         # Generate a blocked off entrance to this sector.  Pathing should create an alternate
         # route from a neighboring sector
         tiles[midline_x-1:midline_x+2, midline_y+3:midline_y+6] = self.tile_set.get_tile_type('floor', 'basic')
         tiles[midline_x-1:midline_x+2,midline_y+5] = self.tile_set.get_tile_type('wall', 'damaged')
-        tiles[midline_x + random.randint(-1,1),midline_y+4] = self.tile_set.get_tile_type('wall', 'damaged')
+        tiles[midline_x + self.rng.randint(-1,1),midline_y+4] = self.tile_set.get_tile_type('wall', 'damaged')
       else:
         tiles[midline_x-1:midline_x+2, midline_y+3:midline_y+20] = self.tile_set.get_tile_type('floor', 'basic')
 
@@ -230,9 +216,9 @@ class HallShip(Ship):
     midline_y = self.sector_height + 8
     for x in range(2,5):
       for y in range(-1,2):
-        if x == 2 or random.random() <.5:
+        if x == 2 or self.rng.random() <.5:
           tiles[x,midline_y + y] = self.tile_set.get_tile_type('wall', 'damaged')
-        if x == 2 or random.random() <.5:
+        if x == 2 or self.rng.random() <.5:
           tiles[(self.sector_width * self.ship_length_in_sectors) - x - 1,midline_y+y] = self.tile_set.get_tile_type('wall', 'damaged')
 
 
@@ -241,7 +227,7 @@ class SphereStarShip(Ship):
 
   def setup(self):
     """ SphereStarShips consist of one central circular sector surrounded by other circles. """
-    self.sector_width = (5 * random.randint(4,6))
+    self.sector_width = (5 * self.rng.randint(4,6))
     self.sector_height = self.sector_width
     print(f'Sector Width: {self.sector_width}, Sector height: {self.sector_height}')
 
@@ -254,7 +240,7 @@ class SphereStarShip(Ship):
       for j in range(3):
         x = i * self.sector_width
         y = j * self.sector_height
-        sector_purpose = random.choice(list(SectorPurpose))
+        sector_purpose = self.rng.choice(list(SectorPurpose))
         if sector_purpose in (SectorPurpose.SCIENCE, SectorPurpose.COMMAND):
           brush_set = brush_sets.get('round')
         elif sector_purpose == SectorPurpose.ENGINEERING:
@@ -262,7 +248,7 @@ class SphereStarShip(Ship):
         else:
           brush_set = brush_sets.get('default')
 
-        is_destroyed = random.random() <= .15
+        is_destroyed = self.rng.random() <= .15
 
         self.sectors.append(Sector(x,
                                     y,
@@ -278,17 +264,11 @@ class SphereStarShip(Ship):
     basic_wall = self.tile_set.get_tile_type('wall', 'basic')
     # Add these here so they don't trigger doors
     radius = (self.sector_width // 2 ) - 2
-    for i in range(3):
-      for j in range(3):
-        start_x, start_y = (self.sector_width * i), (self.sector_height * j)
-        end_x, end_y     = start_x + self.sector_width, start_y + self.sector_height
-        center_x = (self.sector_width * i) + (self.sector_width // 2)
-        center_y = (self.sector_height * j) + (self.sector_height // 2)
-
-        for x in range(start_x, end_x):
-          for y in range(start_y, end_y):
-            if math.sqrt((center_x - x) ** 2 + (center_y - y) **2) > radius:
-              tiles[x,y] = basic_wall
+    # Every sector is the same size, so one disc covers them all
+    outside = ~tile_plans.get_disc_mask(self.sector_width, self.sector_height, radius)
+    outside_sectors = np.full(tiles.shape, False)
+    outside_sectors[:self.sector_width * 3, :self.sector_height * 3] = np.tile(outside, (3, 3))
+    tiles[outside_sectors] = basic_wall
 
     for i in range(3):
       for j in range(3):
@@ -312,18 +292,4 @@ class SphereStarShip(Ship):
           tiles[center_x,(self.sector_height * (j+1)) + 3] = self.tile_set.get_tile_type('door')
 
     # This process often leaves wierd diagonal paths that we want to clean up
-    for x in range(len(tiles)-1):
-      for y in range(len(tiles[0])-1):
-        square = tiles[x:x+2,y:y+2]
-        if square[0,0]['tile_class'] == 'wall' and \
-           square[1,1]['tile_class'] == 'wall' and \
-           square[1,0]['tile_class'] != 'wall' and \
-           square[0,1]['tile_class'] != 'wall':
-          xy = random.choice(((1,0), (0,1)))
-          tiles[x + xy[0], y+xy[1]] = basic_wall
-        elif square[1,0]['tile_class'] == 'wall' and \
-           square[0,1]['tile_class'] == 'wall' and \
-           square[1,1]['tile_class'] != 'wall' and \
-           square[0,0]['tile_class'] != 'wall':
-          xy = random.choice(((1,1), (0,0)))
-          tiles[x + xy[0], y+xy[1]] = basic_wall
+    self.fill_diagonal_gaps(tiles)
@@ -0,0 +1,23 @@
+import copy
+import os
+import sys
+
+import pytest
+
+# The game loads its data files (brushes.json, tilesets...) relative to the repo
+# root and imports its modules from there, so run the tests from it too.
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+os.chdir(root)
+
+@pytest.fixture
+def game_map():
+  """ A freshly generated first floor, always from the same seed. """
+  import entity_factories
+  from engine import Engine
+  from game_map import GameWorld
+
+  engine = Engine(player=copy.deepcopy(entity_factories.player))
+  engine.game_world = GameWorld(engine=engine, viewport_width=50, viewport_height=50, seed=5, pregenerate_floors=0)
+  engine.game_world.generate_floor()
+  return engine.game_map
@@ -0,0 +1,38 @@
+import os
+
+import brushes
+from brushes import Brush, BrushSet, get_compiled_rules
+
+def make_brush_set(name, fill):
+  brush_set = BrushSet(name, brush_size=3)
+  brush_set.add_brush(Brush('solid', 3, [[fill] * 3] * 3))
+  return brush_set
+
+def test_rules_cache_only_clears_its_own_set(tmp_path, monkeypatch):
+  monkeypatch.setattr(brushes, 'rules_cache_dir', str(tmp_path))
+  monkeypatch.setattr(brushes, 'compiled_rules', {})
+
+  get_compiled_rules(make_brush_set('ship-large', 0))
+  get_compiled_rules(make_brush_set('ship', 0))
+  # An edited 'ship' replaces its own old cache file, but not 'ship-large''s
+  ship = make_brush_set('ship', 255)
+  get_compiled_rules(ship)
+
+  files = sorted(os.listdir(tmp_path))
+  assert len(files) == 2
+  assert f'ship-v{brushes.RULES_FORMAT_VERSION}-{ship.get_hash()}.npz' in files
+  assert any(f.startswith('ship-large-') for f in files)
+
+def test_broken_rules_cache_is_recompiled(tmp_path, monkeypatch):
+  monkeypatch.setattr(brushes, 'rules_cache_dir', str(tmp_path))
+  monkeypatch.setattr(brushes, 'compiled_rules', {})
+  ship = make_brush_set('ship', 0)
+  cache_file = tmp_path / f'ship-v{brushes.RULES_FORMAT_VERSION}-{ship.get_hash()}.npz'
+  cache_file.write_bytes(b'PK\x03\x04 not really a zip file')
+
+  rules = get_compiled_rules(ship)
+
+  # The broken file was replaced with a good one, and nothing was left behind
+  assert os.listdir(tmp_path) == [cache_file.name]
+  monkeypatch.setattr(brushes, 'compiled_rules', {})
+  assert (get_compiled_rules(ship).adjacency == rules.adjacency).all()
@@ -0,0 +1,23 @@
+import pickle
+
+import pytest
+
+def test_fov_cache_not_saved(game_map):
+  x, y = game_map.player_start
+  s_x, s_y, fov = game_map.compute_fov(x, y, 8)
+  assert game_map.fov_cache
+
+  loaded = pickle.loads(pickle.dumps(game_map))
+  assert not loaded.fov_cache
+  assert (loaded.compute_fov(x, y, 8)[2] == fov).all()
+
+def test_set_tile_out_of_bounds(game_map):
+  ids = game_map.tiles.ids.copy()
+  bit_codes = game_map.bit_codes.copy()
+  floor = game_map.tile_set.get_tile_type('floor', 'basic')
+  for x, y in ((-1, 0), (0, -1), (game_map.width, 0), (0, game_map.height)):
+    with pytest.raises(IndexError):
+      game_map.set_tile(x, y, floor)
+  # Nothing wrapped around to the other side of the map
+  assert (game_map.tiles.ids == ids).all()
+  assert (game_map.bit_codes == bit_codes).all()
@@ -0,0 +1,72 @@
+import copy
+import threading
+
+import pytest
+
+import entity_factories
+from engine import Engine
+from game_map import GameWorld
+
+def make_world(pregenerate_floors, generation_workers=0):
+  engine = Engine(player=copy.deepcopy(entity_factories.player))
+  engine.game_world = GameWorld(engine=engine, viewport_width=50, viewport_height=50, seed=5,
+                                pregenerate_floors=pregenerate_floors,
+                                generation_workers=generation_workers)
+  return engine.game_world
+
+def record_builds(world, started=None):
+  """ Have world note down (floor, thread name) for every floor it builds.
+  started is set once the worker begins on floor 2. """
+  builds = []
+  build_floor = world.build_floor
+  def recording_build_floor(floor, seed):
+    builds.append((floor, threading.current_thread().name))
+    if floor == 2 and started is not None:
+      started.set()
+    return build_floor(floor, seed)
+  world.build_floor = recording_build_floor
+  return builds
+
+def test_waits_for_floor_being_pregenerated():
+  world = make_world(pregenerate_floors=1)
+  started = threading.Event()
+  builds = record_builds(world, started)
+
+  world.generate_floor()
+  assert started.wait(timeout=10)
+  # Floor 2 is still being built in the background, so this should wait for it
+  world.generate_floor()
+  assert [name for floor, name in builds if floor == 2] == ['floor-pregeneration']
+
+  reference = make_world(pregenerate_floors=0)
+  reference.generate_floor()
+  reference.generate_floor()
+  assert (world.engine.game_map.tiles.ids == reference.engine.game_map.tiles.ids).all()
+
+def test_uses_every_ready_floor():
+  world = make_world(pregenerate_floors=3)
+  builds = record_builds(world)
+
+  world.generate_floor()
+  world._pregeneration_thread.join(timeout=30)
+  # Floors 2-4 are all ready, so none of them should be built again here
+  for _ in range(3):
+    world.generate_floor()
+  assert [floor for floor, name in builds if name == 'MainThread'] == [1]
+
+def test_generation_pool_kept_for_the_run():
+  world = make_world(pregenerate_floors=0, generation_workers=2)
+  pool = world._generation_pool
+  world.generate_floor()
+  world.generate_floor()
+  assert world._generation_pool is pool
+
+  # Worker processes make the same floors as generating in this one
+  reference = make_world(pregenerate_floors=0)
+  reference.generate_floor()
+  reference.generate_floor()
+  assert (world.engine.game_map.tiles.ids == reference.engine.game_map.tiles.ids).all()
+
+  world.shutdown()
+  with pytest.raises(RuntimeError):
+    pool.submit(int)
@@ -0,0 +1,17 @@
+import numpy as np
+
+from lighting import compute_light
+
+def test_light_without_radius_only_lights_its_tile(game_map):
+  x, y = game_map.player_start
+  for radius in (0, -1):
+    s_x, s_y, light_levels = compute_light(game_map, x, y, radius)
+    assert (s_x, s_y) == (slice(x, x + 1), slice(y, y + 1))
+    assert (light_levels == 0).all()
+
+def test_light_levels_fall_off_from_the_light(game_map):
+  x, y = game_map.player_start
+  s_x, s_y, light_levels = compute_light(game_map, x, y, 5)
+  assert light_levels.shape == (s_x.stop - s_x.start, s_y.stop - s_y.start)
+  assert light_levels[x - s_x.start, y - s_y.start] == 0
+  assert ((light_levels >= 0) & (light_levels <= 1)).all()
@@ -0,0 +1,11 @@
+import pickle
+
+from rooms import RoomLabels
+
+def test_rooms_pickle_small(game_map):
+  assert game_map.rooms
+  rooms = pickle.dumps(game_map.rooms)
+  tiles = pickle.dumps(game_map.tiles)
+  # Rooms are just their own coords/walls/exits, not the label grid they were found with
+  assert RoomLabels.__name__.encode() not in rooms
+  assert len(rooms) < 2 * len(tiles)
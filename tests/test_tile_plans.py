@@ -0,0 +1,22 @@
+import math
+
+import numpy as np
+
+from tile_plans import get_disc_mask
+
+def sqrt_disc(width, height, radius):
+  """ The per-cell distance check get_disc_mask replaced. """
+  center_x, center_y = width // 2, height // 2
+  return np.array([[math.sqrt((center_x - x) ** 2 + (center_y - y) ** 2) <= radius
+                    for y in range(height)] for x in range(width)])
+
+def test_disc_mask_matches_distance_check():
+  for radius in (0, 1, 3, 6):
+    assert (get_disc_mask(14, 11, radius) == sqrt_disc(14, 11, radius)).all()
+
+def test_negative_radius_disc_is_empty():
+  for radius in (-1, -4):
+    mask = get_disc_mask(6, 5, radius)
+    assert mask.shape == (6, 5)
+    assert not mask.any()
+    assert (mask == sqrt_disc(6, 5, radius)).all()
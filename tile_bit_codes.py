@@ -1,4 +1,8 @@
-def get_tile_bit_code(tiles, ignore_center=True, tile_classes=['wall','door']):
+import numpy as np
+
+from tile_types import TileClass, TileSubclass, is_tile_class
+
+def get_tile_bit_code(tiles, ignore_center=True, tile_classes=(TileClass.WALL, TileClass.DOOR)):
   """Given a grid of tiles, generate a bit code where each tile that matches
   any of the tile_classes will be an ON bit, and any other tile will be an OFF.
 
@@ -16,13 +20,14 @@ def get_tile_bit_code(tiles, ignore_center=True, tile_classes=['wall','door']):
   # If you "ignore_center" of an even dimensional array, no guarantees what happens :P
   center_x = width // 2
   center_y = height // 2
+  matches = np.isin(tiles['tile_class_code'], tile_classes)
   v = 1 # The current "bit" we're processing, represented as an int.
   for x in range(width):
     for y in range(height):
       if ignore_center and x == center_x and y == center_y:
         # Ignore the center tile
         continue
-      if tiles[x,y]['tile_class'] in tile_classes:
+      if matches[x,y]:
         # This is a tile class we care about, so toggle this tiles bit
         code += v
       v = v * 2 # Bit shift for next iteration
@@ -107,3 +112,71 @@ def get_wall_subclass_for_bit_code(bit_code):
         mapped_codes[bit_code] = subclass
         break
   return subclass
+
+# The 8 neighbours of a tile in the same order get_tile_bit_code walks them, so
+# neighbour i is bit 1 << i.
+neighbor_offsets = ((-1,-1), (-1,0), (-1,1), (0,-1), (0,1), (1,-1), (1,0), (1,1))
+
+def get_bit_codes(matches, pad_value=True):
+  """Whole map version of get_tile_bit_code.  Given a boolean array of which tiles
+  match (ie. are walls or doors), return the 8 bit neighbour code of every tile at
+  once.  Neighbours off the edge of the map count as pad_value."""
+  width, height = matches.shape
+  padded = np.pad(matches, 1, constant_values=pad_value)
+  bit_codes = np.zeros((width, height), dtype=np.uint8)
+  for bit, (d_x, d_y) in enumerate(neighbor_offsets):
+    neighbors = padded[1 + d_x:1 + d_x + width, 1 + d_y:1 + d_y + height]
+    bit_codes |= neighbors.astype(np.uint8) << bit
+  return bit_codes
+
+def get_wall_matches(tiles):
+  """The tiles that count as an ON bit when shaping walls: walls and doors."""
+  return is_tile_class(tiles, TileClass.WALL, TileClass.DOOR)
+
+def update_bit_codes(bit_codes, tiles, x, y, pad_value=True):
+  """The tile at x, y just changed.  Recompute bit_codes in place for the 3x3 block
+  around it, which is every code it's part of.  Returns the block's x and y slices,
+  and a mask of which codes in it changed."""
+  width, height = bit_codes.shape
+  s_x = slice(max(x - 1, 0), min(x + 2, width))
+  s_y = slice(max(y - 1, 0), min(y + 2, height))
+  # The block's codes need one more tile of neighbours on every side, padded
+  # wherever that runs off the map.
+  w_x = slice(max(s_x.start - 1, 0), min(s_x.stop + 1, width))
+  w_y = slice(max(s_y.start - 1, 0), min(s_y.stop + 1, height))
+  window = np.full((s_x.stop - s_x.start + 2, s_y.stop - s_y.start + 2), pad_value)
+  window[w_x.start - s_x.start + 1:w_x.stop - s_x.start + 1,
+         w_y.start - s_y.start + 1:w_y.stop - s_y.start + 1] = get_wall_matches(tiles[w_x, w_y])
+  new_codes = get_bit_codes(window, pad_value)[1:-1, 1:-1]
+  changed = new_codes != bit_codes[s_x, s_y]
+  bit_codes[s_x, s_y] = new_codes
+  return s_x, s_y, changed
+
+def get_padded_bit_code(padded_matches, x, y):
+  """Bit code of the single tile at x, y, where padded_matches has already been padded
+  by one tile on every side the way get_bit_codes does it."""
+  code = 0
+  for bit, (d_x, d_y) in enumerate(neighbor_offsets):
+    if padded_matches[x + 1 + d_x, y + 1 + d_y]:
+      code |= 1 << bit
+  return code
+
+# Every possible bit code run through get_wall_subclass_for_bit_code ahead of time.
+# Holds the TileSubclass for each code, or 0 if no wall shape matches it.
+wall_subclass_lut = np.array([TileSubclass[subclass.upper()] if subclass else 0
+                              for subclass in map(get_wall_subclass_for_bit_code, range(256))],
+                             dtype=np.uint8)
+
+def set_wall_tiles(tiles, tile_set, bit_codes, targets, origin=(0, 0)):
+  """Swap the tiles where targets is True for the wall shape their bit code calls
+  for.  bit_codes and targets line up with each other, and with tiles starting at
+  origin, so this can redo a small block of the map as well as the whole thing.
+  Tiles whose code is 255 (walled in on every side) or has no wall shape are left alone."""
+  subclass_codes = wall_subclass_lut[bit_codes]
+  targets = targets & (bit_codes != 255) & (subclass_codes != 0)
+  for subclass_code in np.unique(subclass_codes[targets]):
+    mask = targets & (subclass_codes == subclass_code)
+    new_tiles = tile_set.get_tile_types('wall', TileSubclass(subclass_code).name.lower(), np.count_nonzero(mask))
+    if new_tiles is not None:
+      xs, ys = np.nonzero(mask)
+      tiles[xs + origin[0], ys + origin[1]] = new_tiles
@@ -0,0 +1,129 @@
+import numpy as np
+
+def find_doorways(tile_plan, wall=0, floor=255):
+  """ Find the floor cells in a WFC tile plan that should become doors.
+
+  A door goes in a one tile gap between two walls, with floor on either side of
+  the gap and some open space diagonally next to it (so we're not filling hallways
+  with doors).  If there's a wall two tiles past the gap, we're probably in a
+  turning hallway and don't need one.  Cells on the outside edge never get doors.
+
+  Returns a boolean mask the same shape as tile_plan.
+  """
+  # Pad with walls two deep so neighbours past the edge never count as floor,
+  # and the "two tiles beyond" check fails near the edges.
+  padded = np.pad(tile_plan, 2, constant_values=wall)
+  is_wall = padded == wall
+  is_floor = padded == floor
+  w, h = tile_plan.shape
+
+  def shifted(mask, dx, dy):
+    return mask[2 + dx:2 + dx + w, 2 + dy:2 + dy + h]
+
+  open_diagonal = shifted(is_floor, -1, -1) | shifted(is_floor, 1, -1) | \
+                  shifted(is_floor, 1, 1) | shifted(is_floor, -1, 1)
+
+  # Walls on the x sides, floor on the y sides
+  vertical = shifted(is_wall, -1, 0) & shifted(is_wall, 1, 0) & \
+             shifted(is_floor, 0, -1) & shifted(is_floor, 0, 1) & \
+             ~shifted(is_wall, 0, -2) & ~shifted(is_wall, 0, 2)
+  # Walls on the y sides, floor on the x sides
+  horizontal = shifted(is_wall, 0, -1) & shifted(is_wall, 0, 1) & \
+               shifted(is_floor, -1, 0) & shifted(is_floor, 1, 0) & \
+               ~shifted(is_wall, -2, 0) & ~shifted(is_wall, 2, 0)
+
+  doors = (tile_plan == floor) & open_diagonal & (vertical | horizontal)
+  doors[0, :] = doors[-1, :] = False
+  doors[:, 0] = doors[:, -1] = False
+
+  # A door stops the floor next to it counting as floor, so don't put two side by side.
+  # Keep the first one in x then y order.
+  crowded = np.zeros_like(doors)
+  crowded[1:, :] |= doors[:-1, :]
+  crowded[:, 1:] |= doors[:, :-1]
+  return doors & ~crowded
+
+def get_disc_mask(width, height, radius, center=None):
+  """ True for every cell of a width x height block that's within radius of center
+  (the middle of the block by default).  A negative radius covers nothing. """
+  if radius < 0:
+    return np.full((width, height), False)
+  if center is None:
+    center = (width // 2, height // 2)
+  xs, ys = np.ogrid[:width, :height]
+  return (xs - center[0]) ** 2 + (ys - center[1]) ** 2 <= radius ** 2
+
+def find_diagonal_gaps(walls):
+  """ Find 2x2 squares where two walls only touch diagonally, leaving a gap you
+  could squeeze (or leak) through between them.
+
+  Given a boolean wall mask, returns two masks one smaller in each direction,
+  marking the top left corner of each square:  falling, where the walls are at
+  (0,0) and (1,1), and rising, where they're at (1,0) and (0,1).
+  """
+  top_left, bottom_right = walls[:-1, :-1], walls[1:, 1:]
+  bottom_left, top_right = walls[1:, :-1], walls[:-1, 1:]
+  falling = top_left & bottom_right & ~bottom_left & ~top_right
+  rising = bottom_left & top_right & ~top_left & ~bottom_right
+  return falling, rising
+
+def label_regions(mask):
+  """ Number the 4-connected regions of True cells in a boolean mask.
+
+  Returns (labels, count):  labels is an int32 grid the same shape as mask, 0
+  wherever mask is False and 1 to count everywhere else.  Regions are numbered in
+  the order you'd reach their first cell scanning x then y.
+
+  Works on runs of cells down each column rather than single cells, joining runs
+  that overlap the run next to them, so it's linear in the size of the map and
+  never recurses.
+  """
+  width, height = mask.shape
+  # Each column's runs start where the mask turns on and end (exclusive) where it turns off
+  padded = np.zeros((width, height + 2), dtype=np.int8)
+  padded[:, 1:-1] = mask
+  edges = np.diff(padded, axis=1)
+  run_x, run_start = np.nonzero(edges == 1)
+  run_end = np.nonzero(edges == -1)[1]
+  run_count = len(run_x)
+
+  # Give every cell a key that sorts by x then y, and slide each run over into
+  # the next column.  A run overlaps the runs in the column before it that end
+  # after it starts and start before it ends.
+  stride = height + 1
+  starts = run_x * stride + run_start
+  ends = run_x * stride + run_end
+  first = np.searchsorted(ends + stride, starts, side='right')
+  last = np.searchsorted(starts + stride, ends, side='left')
+  overlaps = np.maximum(last - first, 0)
+  runs = np.repeat(np.arange(run_count), overlaps)
+  neighbors = np.repeat(first - np.cumsum(overlaps) + overlaps, overlaps) + np.arange(len(runs))
+
+  # Union find over the overlapping runs
+  parent = list(range(run_count))
+  def find(run):
+    while parent[run] != run:
+      parent[run] = parent[parent[run]]
+      run = parent[run]
+    return run
+  for run, neighbor in zip(runs.tolist(), neighbors.tolist()):
+    root, other = find(run), find(neighbor)
+    if root != other:
+      # Keep the earlier run as the root so regions number in scan order
+      if root < other:
+        parent[other] = root
+      else:
+        parent[root] = other
+  roots = np.array([find(run) for run in range(run_count)], dtype=np.int64)
+
+  # Roots are always the region's first run, so numbering them in order numbers the regions
+  is_root = roots == np.arange(run_count)
+  region = np.cumsum(is_root).astype(np.int32)[roots]
+  count = int(np.count_nonzero(is_root))
+
+  # Paint each run's number down its column
+  steps = np.zeros((width, height + 1), dtype=np.int32)
+  steps[run_x, run_start] = region
+  steps[run_x, run_end] = -region
+  labels = np.asfortranarray(np.cumsum(steps, axis=1)[:, :height], dtype=np.int32)
+  return labels, count
@@ -1,15 +1,19 @@
 import numpy as np
 import random
-from enum import Enum, auto
+from enum import IntEnum, auto
 
-class TileClass(Enum):
+# Tile classes and subclasses are stored on tiles as these integer codes, so checks
+# over the whole map are integer compares.  Member names are the upper cased
+# names used in the tile sets, ie. 'closed' is TileSubclass.CLOSED.
+class TileClass(IntEnum):
   FLOOR = auto()
   WALL = auto()
   DOOR = auto()
   OBSTACLE = auto()
   INTERACTABLE = auto()
+  SPACE = auto()
 
-class TileSubclass(Enum):
+class TileSubclass(IntEnum):
   BASIC = auto()
   DAMAGED = auto()
   HALL = auto()
@@ -18,6 +22,20 @@ class TileSubclass(Enum):
   STORAGE = auto()
   TRIGGER = auto()
   EXIT = auto()
+  # Decorated walls, named after the directions they connect in.  See tile_bit_codes.
+  H = auto()
+  V = auto()
+  DR = auto()
+  DL = auto()
+  UR = auto()
+  UL = auto()
+  TR = auto()
+  TL = auto()
+  TD = auto()
+  TU = auto()
+  X = auto()
+  PILLAR = auto()
+  GLASS = auto()
 
 # Tile graphics structured type compatible with Console.tiles_rgb
 graphic_dt = np.dtype(
@@ -37,10 +55,46 @@ tile_dt = np.dtype(
     ("light", graphic_dt),  # Graphics for when the tile is in FOV.
     ('tile_class', np.unicode_, 16),
     ('tile_subclass', np.unicode_, 16),
-    ('weight', np.int8)
+    ('weight', np.int8),
+    ('tile_id', np.uint16), # Index into the owning TileSet's palette
+    ('tile_class_code', np.uint8), # TileClass
+    ('tile_subclass_code', np.uint8), # TileSubclass
   ]
 )
 
+def get_tile_class_code(tile_class):
+  return TileClass[tile_class.upper()]
+
+def get_tile_subclass_code(tile_subclass):
+  return TileSubclass[tile_subclass.upper()]
+
+# Predicates for tiles.  Each takes a single tile, an array of them or a whole TileGrid
+# and returns a bool (or bool array) the same shape.
+def is_tile_class(tiles, *tile_classes):
+  """ True where tiles are any of the given TileClasses. """
+  codes = tiles['tile_class_code']
+  if len(tile_classes) == 1:
+    return codes == tile_classes[0]
+  return np.isin(codes, tile_classes)
+
+def is_floor(tiles):
+  return tiles['tile_class_code'] == TileClass.FLOOR
+
+def is_wall(tiles):
+  return tiles['tile_class_code'] == TileClass.WALL
+
+def is_space(tiles):
+  return tiles['tile_class_code'] == TileClass.SPACE
+
+def is_door(tiles):
+  return tiles['tile_class_code'] == TileClass.DOOR
+
+def is_door_open(tiles):
+  return (tiles['tile_class_code'] == TileClass.DOOR) & (tiles['tile_subclass_code'] == TileSubclass.OPEN)
+
+def is_door_closed(tiles):
+  return (tiles['tile_class_code'] == TileClass.DOOR) & (tiles['tile_subclass_code'] == TileSubclass.CLOSED)
+
 def new_tile(*,  # Enforce the use of keywords, so that parameter order doesn't matter.
              walkable,
              transparent,
@@ -51,14 +105,19 @@ def new_tile(*,  # Enforce the use of keywords, so that parameter order doesn't
              tile_subclass,
              weight):
     """Helper function for defining individual tile types """
-    return np.array((walkable, transparent, dark, light, tile_class,tile_subclass,weight), dtype=tile_dt)
+    return np.array((walkable, transparent, dark, light, tile_class,tile_subclass,weight, 0,
+                     get_tile_class_code(tile_class), get_tile_subclass_code(tile_subclass)), dtype=tile_dt)
 
 # SHROUD represents unexplored, unseen tiles
 SHROUD = np.array((ord(' '), (255,255,255), (0,0,0)), dtype=graphic_dt)
 
 class TileSet:
   def __init__(self):
+    # Set to a seeded random.Random when a ship takes ownership of this tile set
+    self.rng = None
     self.all_tile_types = []
+    self._palette = None
+    self._weighted_options = {}
     self.tile_classes = {'floor': {'basic': [],
                                    'damaged': []},
                          'wall': {'basic': [],
@@ -67,23 +126,29 @@ class TileSet:
                                   'closed': [],},
                          'obstacle': {'basic': []},
                          'interactable': {'storage': [],
-                                          'triggers': [],
+                                          'trigger': [],
                                           'exit': []},
                           }
 
   def copy(self):
+    # Add them back in the same order so tile IDs line up between copies
     tile_set = TileSet()
-    for tile_class, tile_subclasses in self.tile_classes.items():
-      for tile_subclass, tiles in tile_subclasses.items():
-        for tile in tiles:
-          tile_set.add_tile_type(tile_class, tile_subclass,
-                                 tile['walkable'],
-                                 tile['transparent'],
-                                 tile['dark'],
-                                 tile['light'],
-                                 tile['weight'])
+    for tile in self.all_tile_types:
+      tile_set.add_tile_type(str(tile['tile_class']), str(tile['tile_subclass']),
+                             tile['walkable'],
+                             tile['transparent'],
+                             tile['dark'],
+                             tile['light'],
+                             tile['weight'])
     return tile_set
 
+  @property
+  def palette(self):
+    """ Every tile type in this set as one tile_dt array, indexed by tile_id. """
+    if self._palette is None:
+      self._palette = np.array(self.all_tile_types, dtype=tile_dt)
+    return self._palette
+
   def is_tile_class(self, tile_type, tile_class, tile_subclass=None):
     """ Check to see if the passed in tile is part of a tile_class """
     tile_types = []
@@ -94,19 +159,50 @@ class TileSet:
         tile_types.extend(sub_types)
     return tile_type in tile_types
 
-  def get_tile_type(self, tile_class, tile_subclass=None):
+  def get_tile_options(self, tile_class, tile_subclass=None):
+    """ All the tile types a class/subclass can be drawn from. """
     tile_subclasses = self.tile_classes.get(tile_class, {})
     if tile_subclass:
-      options = tile_subclasses.get(tile_subclass, [])
-    else:
-      # Choose from all tile_subclasses, useful for randomly selecting
-      # open/closed doors
-      options = []
-      for k, v in tile_subclasses.items():
-        options.extend(v)
+      return tile_subclasses.get(tile_subclass, [])
+    # Choose from all tile_subclasses, useful for randomly selecting
+    # open/closed doors
+    options = []
+    for k, v in tile_subclasses.items():
+      options.extend(v)
+    return options
+
+  def clear_caches(self):
+    """ Call after changing tile types in place (eg. tinting them). """
+    self._palette = None
+    self._weighted_options = {}
+
+  def get_tile_types(self, tile_class, tile_subclass=None, count=1, rng=None):
+    """ Like get_tile_type, but draws count weighted tiles in one go and returns
+    them as an array of tile_dt.  count can also be a shape, eg. (width, height)
+    for a whole map's worth.  rng is a numpy Generator, if not passed one is
+    seeded from this tile set's rng. """
+    key = (tile_class, tile_subclass)
+    weighted = self._weighted_options.get(key)
+    if weighted is None:
+      options = self.get_tile_options(tile_class, tile_subclass)
+      if not options:
+        print(f'No options for tile class {tile_class}:{tile_subclass}')
+        return None
+      options = np.array(options, dtype=tile_dt)
+      weights = options['weight'].astype(np.float64)
+      weighted = self._weighted_options[key] = (options, weights / weights.sum())
+    options, p = weighted
+    if len(options) == 1:
+      return np.full(count, options[0])
+    if rng is None:
+      rng = np.random.default_rng((self.rng or random).getrandbits(64))
+    return options[rng.choice(len(options), size=count, p=p)]
+
+  def get_tile_type(self, tile_class, tile_subclass=None):
+    options = self.get_tile_options(tile_class, tile_subclass)
 
     if options:
-      chosen = random.choices(
+      chosen = (self.rng or random).choices(
         options, weights=[o['weight'] for o in options], k=1
       )
       if chosen:
@@ -125,11 +221,68 @@ class TileSet:
                     dark,
                     light,
                     weight):
-    tile_type = np.array((walkable, transparent, dark, light, tile_class,tile_subclass,weight), dtype=tile_dt)
+    tile_type = np.array((walkable, transparent, dark, light, tile_class,tile_subclass,weight,
+                          len(self.all_tile_types),
+                          get_tile_class_code(tile_class),
+                          get_tile_subclass_code(tile_subclass)), dtype=tile_dt)
     tile_subclasses = self.tile_classes.setdefault(tile_class, {})
     tile_types = tile_subclasses.setdefault(tile_subclass, [])
     tile_types.append(tile_type)
     self.all_tile_types.append(tile_type)
+    self.clear_caches()
+
+
+class TileGrid:
+  """
+  A map's worth of tiles, stored as a grid of uint16 tile IDs into a TileSet's
+  palette rather than a full tile_dt record per cell.
+
+  Indexes like the structured array it replaces: tiles[x, y] (or any slice/mask)
+  gives tile records, tiles['walkable'] gives that field for the whole map, and
+  assigning tile records stores their IDs.  Whole-map field layers are built the
+  first time they're asked for and kept up to date as cells change, so treat them
+  as read only.  The palette is taken from the tile set when the grid is made.
+  """
+  def __init__(self, tile_set, shape, fill_value):
+    self.tile_set = tile_set
+    self.palette = tile_set.palette
+    self.ids = np.full(shape, fill_value['tile_id'], dtype=np.uint16, order='F')
+    self._layers = {}
+
+  @property
+  def shape(self):
+    return self.ids.shape
+
+  def __len__(self):
+    return len(self.ids)
+
+  def layer(self, field):
+    """ The given tile_dt field for every cell on the map. """
+    layer = self._layers.get(field)
+    if layer is None:
+      layer = self._layers[field] = np.asfortranarray(self.palette[field][self.ids])
+    return layer
+
+  def __getitem__(self, key):
+    if key.__class__ is str:
+      return self.layer(key)
+    return self.palette[self.ids[key]]
+
+  def __setitem__(self, key, value):
+    if isinstance(key, str):
+      raise TypeError(f'The {key} layer is read only, assign tiles instead')
+    self.ids[key] = value['tile_id']
+    if self._layers:
+      ids = self.ids[key]
+      palette = self.palette
+      for field, layer in self._layers.items():
+        layer[key] = palette[field][ids]
+
+  def __getstate__(self):
+    # Layers are cheap to rebuild and most of the size
+    state = self.__dict__.copy()
+    state['_layers'] = {}
+    return state
 
 
 basic_floor_fg_dark = (255,255,255)
@@ -1,7 +1,9 @@
 import random
 import io
+import heapq
+import time
 import base64
-from collections import namedtuple
+from collections import namedtuple, deque
 import numpy as np
 #from PIL import Image
 #from IPython import display
@@ -101,39 +103,297 @@ def create_tiles(source, tile_size=2):
   #print(tiles)
   return tiles
 
-def run_iteration(tiles, weights, old_potential):
-    potential = old_potential.copy()
-    to_collapse = location_with_fewest_choices(potential) #3
-    if to_collapse is None:                               #1
-        raise StopIteration()
-    elif not np.any(potential[to_collapse]):              #2
-        raise Exception(f"No choices left at {to_collapse}")
-    else:                                                 #4 ↓
-        #nonzero = find_true(potential[to_collapse])
-        #tile_probs = weights[nonzero]/sum(weights[nonzero])
-        #selected_tile = np.random.choice(nonzero, p=tile_probs)
-        #potential[to_collapse] = False
-        #potential[to_collapse][selected_tile] = True
-        #propagate(tiles, potential, to_collapse)                 #5
-        potential = collapse(tiles, weights, potential, to_collapse)
-    return potential
-
-def collapse(tiles, weights, potential, to_collapse):
-  nonzero = find_true(potential[to_collapse])
-  tile_probs = weights[nonzero]/sum(weights[nonzero])
-  selected_tile = np.random.choice(nonzero, p=tile_probs)
-  #print(f'{to_collapse} is now {tiles[selected_tile]}')
-  #import pdb; pdb.set_trace()
-  potential[to_collapse] = False
-  potential[to_collapse][selected_tile] = True
-  propagate(tiles, potential, to_collapse)
-  return potential
-
-def location_with_fewest_choices(potential):
+class Contradiction(Exception):
+  """Raised when propagation leaves a cell with no possible patterns."""
+  def __init__(self, location):
+    super().__init__(f"No patterns left at {location}")
+    self.location = location
+
+# Limits for the solver in get_wfc.  When a collapse leads to a contradiction we
+# undo decisions off a stack of at most max_depth change-logs, up to max_backtracks
+# times.  Past that we wipe a square of local_radius around the contradiction and
+# re-solve just that patch, and only after max_local_restarts of those do we throw
+# the whole grid away.  After max_restarts (or max_tries collapses), on_give_up
+# decides whether we 'raise' a Contradiction or 'keep' the partially solved grid.
+SolverPolicy = namedtuple('SolverPolicy', ('max_depth', 'max_backtracks', 'local_radius',
+                                           'max_local_restarts', 'max_restarts', 'max_tries',
+                                           'on_give_up'))
+
+backtrack_policy = SolverPolicy(max_depth=64, max_backtracks=200, local_radius=3,
+                                max_local_restarts=10, max_restarts=20, max_tries=20000,
+                                on_give_up='keep')
+# The old behavior: start over from scratch on every contradiction.
+restart_policy = SolverPolicy(max_depth=0, max_backtracks=0, local_radius=0,
+                              max_local_restarts=0, max_restarts=5000, max_tries=5000,
+                              on_give_up='keep')
+
+class CompiledRules:
+  """
+  A tile set boiled down to what the solver needs: the deduplicated pattern
+  data, an integer signature for each side of each pattern (in Direction
+  order), the pattern weights, and one adjacency matrix per Direction where
+  adjacency[d, i, j] is True if pattern j may sit on the d side of pattern i.
+  """
+  def __init__(self, patterns, sides, weights, adjacency=None):
+    self.patterns = patterns
+    self.sides = sides
+    self.weights = weights
+    if adjacency is None:
+      adjacency = np.zeros((4, len(sides), len(sides)), dtype=bool)
+      for direction in Direction:
+        outgoing = sides[:, direction.value]
+        incoming = sides[:, direction.reverse().value]
+        adjacency[direction.value] = outgoing[:, None] == incoming[None, :]
+    self.adjacency = adjacency
+
+  @property
+  def tile_size(self):
+    return self.patterns.shape[1]
+
+def compile_rules(patterns, weights):
+  """
+  Build CompiledRules out of a list of square pattern arrays and their weights.
+  Duplicate patterns (like the rotations of a symmetric brush) are merged and
+  their weights summed, which doesn't change how often each one gets picked.
+  """
+  merged = {}
+  for data, weight in zip(patterns, weights):
+    data = np.asarray(data)
+    key = (data.shape, data.astype(np.int64).tobytes())
+    if key in merged:
+      merged[key][1] += weight
+    else:
+      merged[key] = [data, weight]
+
+  patterns = np.array([data for data, weight in merged.values()])
+  weights = np.array([weight for data, weight in merged.values()])
+  # Right, Up, Left, Down, same as get_tile_sides
+  edges = np.stack((patterns[:, :, -1], patterns[:, 0, :], patterns[:, :, 0], patterns[:, -1, :]), axis=1)
+  edge_values, sides = np.unique(edges.reshape(-1, patterns.shape[1]), axis=0, return_inverse=True)
+  return CompiledRules(patterns, sides.reshape(-1, 4), weights)
+
+class Decision:
+  """A single collapse, plus a log of every row it changed so it can be undone."""
+  def __init__(self, location, pattern):
+    self.location = location
+    self.pattern = pattern
+    self.changes = []
+
+class GaveUp(Exception):
+  """Raised inside Solver once its policy has run out of ways to recover."""
+  pass
+
+class Solver:
+  """
+  Collapses a potential array in place, backtracking out of contradictions
+  instead of starting the whole grid over.
+  """
+  def __init__(self, adjacency, weights, height, width, policy=backtrack_policy, rng=np.random):
+    self.adjacency = adjacency
+    self.weights = weights
+    self.policy = policy
+    self.rng = rng
+    self.potential = np.full((height, width, len(weights)), True)
+    self.queue = EntropyQueue(self.potential, weights, rng)
+    self.decisions = deque(maxlen=policy.max_depth or None)
+    self.select_time = 0
+    self.tries = 0
+    self.collapses = 0
+    self.contradictions = 0
+    self.backtracks = 0
+    self.local_restarts = 0
+    self.restarts = 0
+    self.gave_up = False
+    self.last_contradiction = None
+    self.reset_counters()
+
+  def reset_counters(self):
+    # Backtracks and local restarts are budgeted per attempt at the whole grid
+    self.attempt_backtracks = 0
+    self.attempt_local_restarts = 0
+
+  def solve(self):
+    try:
+      while self.step():
+        pass
+    except GaveUp:
+      self.gave_up = True
+      if self.policy.on_give_up == 'raise':
+        raise Contradiction(self.last_contradiction)
+      print(f'WFC gave up after {self.restarts} restarts, keeping the partial grid')
+    self.select_time += self.queue.select_time
+    return self.potential
+
+  def step(self):
+    """Collapse one cell.  Returns False once every cell is decided."""
+    if self.tries >= self.policy.max_tries:
+      raise GaveUp()
+    self.tries += 1
+    location = self.queue.pop()
+    if location is None:
+      return False
+
+    possible = self.potential[location]
+    nonzero = np.flatnonzero(possible)
+    tile_probs = self.weights[nonzero] / self.weights[nonzero].sum()
+    pattern = self.rng.choice(nonzero, p=tile_probs)
+
+    decision = Decision(location, pattern)
+    decision.changes.append((location, possible.copy()))
+    self.potential[location] = False
+    self.potential[location][pattern] = True
+    if self.policy.max_depth:
+      self.decisions.append(decision)
+    self.collapses += 1
+    try:
+      changed = propagate(self.adjacency, self.potential, [location], decision.changes)
+      self.queue.update(self.potential, changed)
+    except Contradiction as e:
+      self.resolve(e.location)
+    return True
+
+  def undo(self, decision):
+    for location, row in reversed(decision.changes):
+      self.potential[location] = row
+    self.queue.update(self.potential, {location for location, row in decision.changes})
+
+  def resolve(self, location):
+    """Back out of a contradiction at location."""
+    self.contradictions += 1
+    self.last_contradiction = location
+    while True:
+      if not self.decisions or self.attempt_backtracks >= self.policy.max_backtracks:
+        self.local_restart(location)
+        return
+      decision = self.decisions.pop()
+      self.undo(decision)
+      self.backtracks += 1
+      self.attempt_backtracks += 1
+
+      # That pattern doesn't work here given everything decided before it.  Rule it
+      # out, logging the change against the previous decision so it gets undone
+      # along with it if that one turns out to be wrong too.
+      changes = self.decisions[-1].changes if self.decisions else None
+      if changes is not None:
+        changes.append((decision.location, self.potential[decision.location].copy()))
+      self.potential[decision.location][decision.pattern] = False
+      if not self.potential[decision.location].any():
+        self.contradictions += 1
+        location = decision.location
+        continue
+      try:
+        changed = propagate(self.adjacency, self.potential, [decision.location], changes)
+        self.queue.update(self.potential, changed)
+        return
+      except Contradiction as e:
+        self.contradictions += 1
+        location = e.location
+
+  def local_restart(self, location):
+    """Wipe a patch around location and re-solve only that."""
+    self.attempt_local_restarts += 1
+    if self.attempt_local_restarts > self.policy.max_local_restarts:
+      self.restart()
+      return
+    self.local_restarts += 1
+    # The change-logs on the stack don't know about the patch we're wiping
+    self.decisions.clear()
+
+    height, width = self.potential.shape[:2]
+    radius = self.policy.local_radius
+    x, y = location
+    x1, x2 = max(0, x - radius), min(height, x + radius + 1)
+    y1, y2 = max(0, y - radius), min(width, y + radius + 1)
+    self.potential[x1:x2, y1:y2] = True
+    patch = [(px, py) for px in range(x1, x2) for py in range(y1, y2)]
+    # Let the cells bordering the patch constrain it again
+    border = set()
+    for patch_location in patch:
+      for direction, n_x, n_y in neighbors(patch_location, height, width):
+        if not (x1 <= n_x < x2 and y1 <= n_y < y2):
+          border.add((n_x, n_y))
+    try:
+      changed = propagate(self.adjacency, self.potential, list(border))
+    except Contradiction:
+      self.contradictions += 1
+      self.restart()
+      return
+    self.queue.update(self.potential, changed.union(patch))
+
+  def restart(self):
+    self.restarts += 1
+    if self.restarts > self.policy.max_restarts:
+      raise GaveUp()
+    self.potential[:] = True
+    self.select_time += self.queue.select_time
+    self.queue = EntropyQueue(self.potential, self.weights, self.rng)
+    self.decisions.clear()
+    self.reset_counters()
+
+class EntropyQueue:
+  """
+  Min-heap of undecided cells keyed by their weighted Shannon entropy.
+
+  Only the cells propagation actually changed get re-scored, instead of
+  summing the whole potential array on every collapse.  Stale heap entries
+  are skipped lazily when popped, and a little random noise on every entry
+  breaks ties between equally uncertain cells.
+  """
+  def __init__(self, potential, weights, rng=np.random):
+    self.weights = weights
+    self.weight_log_weights = weights * np.log(weights)
+    self.rng = rng
+    self.entropies = {}
+    self.heap = []
+    self.updates = 0
+    self.select_time = 0
+
+    # Every cell starts out with every pattern, so they all share one entropy.
+    height, width = potential.shape[:2]
+    entropy = self.entropy(potential[0, 0])
+    noise = self.rng.random(height * width) * 1e-6
+    for i, location in enumerate(np.ndindex(height, width)):
+      self.entropies[location] = entropy + noise[i]
+      self.heap.append((entropy + noise[i], location))
+    heapq.heapify(self.heap)
+
+  def entropy(self, possible):
+    sum_weights = self.weights[possible].sum()
+    return np.log(sum_weights) - self.weight_log_weights[possible].sum() / sum_weights
+
+  def update(self, potential, locations):
+    start = time.perf_counter()
+    for location in locations:
+      self.updates += 1
+      possible = potential[location]
+      if np.count_nonzero(possible) <= 1:
+        # Decided (or contradicted, which propagation reports for us)
+        self.entropies.pop(location, None)
+        continue
+      entropy = self.entropy(possible) + self.rng.random() * 1e-6
+      self.entropies[location] = entropy
+      heapq.heappush(self.heap, (entropy, location))
+    self.select_time += time.perf_counter() - start
+
+  def pop(self):
+    """Return the undecided cell with the lowest entropy, or None if every cell is decided."""
+    start = time.perf_counter()
+    location = None
+    while self.heap:
+      entropy, candidate = heapq.heappop(self.heap)
+      if self.entropies.get(candidate) == entropy:
+        del self.entropies[candidate]
+        location = candidate
+        break
+    self.select_time += time.perf_counter() - start
+    return location
+
+def location_with_fewest_choices(potential, rng=random):
+    """ The old full-grid selector.  benchmark.py times it against the entropy queue. """
     num_choices = np.sum(potential, axis=2, dtype='float32')
     num_choices[num_choices == 1] = np.inf
     candidate_locations = find_true(num_choices == num_choices.min())
-    location = random.choice(candidate_locations)
+    location = rng.choice(candidate_locations)
     if num_choices[location] == np.inf:
         return None
     return location
@@ -162,83 +422,76 @@ def neighbors(location, height, width):
         res.append((Direction.RIGHT, x, y+1))
     return res
 
-def propagate(tiles, potential, start_location):
+def propagate(adjacency, potential, start_locations, changes=None):
+    """
+    AC-3 style propagation.  Every cell on the worklist narrows its neighbors
+    down to the patterns its own remaining patterns allow, and any neighbor
+    that actually changed is queued in turn.  Returns the set of cells whose
+    patterns changed (including the start locations).  If a changes list is
+    passed in, the old row of every cell we touch is appended to it.
+    """
     height, width = potential.shape[:2]
-    needs_update = np.full((height, width), False)
-    needs_update[start_location] = True
-    while np.any(needs_update):
-        needs_update_next = np.full((height, width), False)
-        locations = find_true(needs_update)
-        for location in locations:
-            #import pdb; pdb.set_trace()
-            possible_tiles = [tiles[n] for n in find_true(potential[location])]
-            #print(possible_tiles)
-            for neighbor in neighbors(location, height, width):
-                neighbor_direction, neighbor_x, neighbor_y = neighbor
-                neighbor_location = (neighbor_x, neighbor_y)
-                was_updated = add_constraint(tiles, potential, neighbor_location,
-                                             neighbor_direction, possible_tiles)
-                needs_update_next[location] |= was_updated
-        needs_update = needs_update_next
-
-def add_constraint(tiles, potential, location, incoming_direction, possible_tiles):
-    neighbor_constraint = {t.sides[incoming_direction.value] for t in possible_tiles}
-    outgoing_direction = incoming_direction.reverse()
-    changed = False
-    #print(f'Checking neighbor against {neighbor_constraint}')
-    for i_p, p in enumerate(potential[location]):
-        if not p:
-            continue
-        #print(f'Searching for {tiles[i_p].sides[outgoing_direction.value]} in {neighbor_constraint}')
-        if tiles[i_p].sides[outgoing_direction.value] not in neighbor_constraint:
-            #print(f'Invalid {tiles[i_p].sides[outgoing_direction.value]}')
-            potential[location][i_p] = False
-            changed = True
-        #else:
-          #print(f'Valid {tiles[i_p].sides[outgoing_direction.value]}')
-    #import pdb; pdb.set_trace()
-    #print(f'{potential[location]}, {np.any(potential[location])}')
-    if not np.any(potential[location]):
-        raise Exception(f"No patterns left at {location}")
+    worklist = deque(start_locations)
+    queued = set(start_locations)
+    changed = set(start_locations)
+    while worklist:
+        location = worklist.popleft()
+        queued.discard(location)
+        possible = potential[location]
+        for direction, neighbor_x, neighbor_y in neighbors(location, height, width):
+            neighbor_location = (neighbor_x, neighbor_y)
+            current = potential[neighbor_location]
+            allowed = adjacency[direction.value][possible].any(axis=0)
+            updated = current & allowed
+            if not updated.any():
+                raise Contradiction(neighbor_location)
+            if np.count_nonzero(updated) != np.count_nonzero(current):
+                if changes is not None:
+                    changes.append((neighbor_location, current.copy()))
+                potential[neighbor_location] = updated
+                changed.add(neighbor_location)
+                if neighbor_location not in queued:
+                    queued.add(neighbor_location)
+                    worklist.append(neighbor_location)
     return changed
 
-def get_wfc(source=None, tiles=[], tile_size=2, width=20, height=20):
-  if source is not None:
-    tiles = create_tiles(source, tile_size)
+def get_wfc(source=None, tiles=[], tile_size=2, width=20, height=20, stats=None,
+            policy=backtrack_policy, rules=None, seed=None):
+  """
+  Generate a width x height grid of tiles and return it stamped out as pixels.
+  Patterns come from precompiled rules if given, otherwise from tiles (or
+  cut out of a source image).  If a stats dict is passed in, it will be
+  filled in with a trace of the run.  Passing a seed makes the result
+  reproducible without touching the global numpy random state.
+  """
+  if rules is None:
+    if source is not None:
+      tiles = create_tiles(source, tile_size)
+    rules = compile_rules([t.data for t in tiles], [t.weight for t in tiles])
+  tile_size = rules.tile_size
 
-  weights = np.asarray([t.weight for t in tiles])
-  #for t in tiles:
-  #  print(t.weight, t.data)
-  p = np.full((height, width, len(tiles)), True)
+  rng = np.random.default_rng(seed) if seed is not None else np.random
+  solver = Solver(rules.adjacency, rules.weights, height, width, policy, rng)
 
-  tries = 0
-  while tries < 5000:
-      try:
-          p = run_iteration(tiles, weights, p)
-          #images.append(show_state(p, tiles))  # Move me for speed
-      except StopIteration as e:
-          break
-      except:
-        p = np.full((height, width, len(tiles)), True)
-      tries += 1
-
-  print(tries)
-  p = p.tolist()
-  pixels = np.full((height * (tile_size), width * (tile_size)), 0)
-  #print(len(p), len(pixels), len(p[0]), len(pixels[0]))
-  rows = []
-  for x, row in enumerate(p):
-    #print(x, row)
-    new_row = []
-    for y, r in enumerate(row):
-      for t, tf in enumerate(r):
-        if tf:
-          #print(tiles[t].data)
-          #print(x, y, x*tile_size, x*tile_size+tile_size, y*tile_size, y*tile_size+tile_size, len(pixels), len(pixels[0]))
-          pixels[x*(tile_size):x*(tile_size)+tile_size,y*(tile_size):y*(tile_size)+tile_size] = tiles[t].data
-          #new_row.append(tiles[t])
-    #rows.append(new_row)
+  p = solver.solve()
+
+  if stats is not None:
+    stats.update({'tries': solver.tries,
+                  'collapses': solver.collapses,
+                  'contradictions': solver.contradictions,
+                  'backtracks': solver.backtracks,
+                  'local_restarts': solver.local_restarts,
+                  'restarts': solver.restarts,
+                  'gave_up': solver.gave_up,
+                  'select_time': solver.select_time,
+                  'width': width,
+                  'height': height,
+                  'patterns': len(rules.weights)})
 
+  # Stamp the chosen pattern of every cell into the output.  If we gave up
+  # with cells still undecided, use the last possible pattern like we always have.
+  chosen = p.shape[2] - 1 - np.argmax(p[:, :, ::-1], axis=2)
+  pixels = rules.patterns[chosen].swapaxes(1, 2).reshape(height * tile_size, width * tile_size)
   #print('\n'.join([''.join(str(c) for c in r) for r in pixels.tolist()]))
   return pixels
 